@@ -0,0 +1,225 @@
+#!/usr/bin/python
+'''Times precache against a local stand-in server, without network access.
+Fixtures are built in a temporary directory and served by server.py with
+the supplied latency and bandwidth. Each benchmark is run cold (with an
+empty state directory) and warm (with the state left by the cold run).
+
+Results can be saved as JSON with --output, and compared to a previous
+run with --compare:
+
+    ./benchmark.py --latency 0.05 --output before.json
+    ./benchmark.py --latency 0.05 --compare before.json
+
+Configuration keys (for example metadataWorkers) can be changed for a run
+with --set key=value.
+
+The mdm benchmarks request the device models from the Jamf Pro, Jamf
+Classic and SimpleMDM stand-ins, and fail if the counts don't add up to the
+devices in the fixtures across every page.
+'''
+import argparse
+import collections
+import json
+import os
+import plistlib
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+from requests.adapters import HTTPAdapter
+from time import sleep
+from time import time
+
+import fixtures
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Items cached by the main_processor benchmark
+MODELS = ['iPad6,8', 'iPhone9,1', 'AppleTV5,3']
+IPSW = ['iPhone9,1', 'iPad6,8']
+MAC_UPDATES = ['Safari', 'Security']
+APPS = ['Xcode', 'Sierra']
+
+
+class PlainHTTPAdapter(HTTPAdapter):
+    '''Sends https:// requests as http://. Jamf servers have to be https://
+    URLs, but the stand-in server doesn't use TLS.'''
+    def send(self, request, **kwargs):
+        request.url = 'http://%s' % request.url[len('https://'):]
+        return HTTPAdapter.send(self, request, **kwargs)
+
+
+def mdm_models(p, mdm, path):
+    '''Returns the device models from the MDM stand-in at /mdm/<path>,
+    raising an exception if the counts don't match the fixtures.'''
+    if mdm == 'jamf':
+        server = p.configuration['mdmServer'].replace('/mdm/jamf', '/mdm/%s' % path).replace('http://', 'https://', 1)  # NOQA
+        p.session.mount(server, PlainHTTPAdapter())
+        models = p.mdm_models(mdm=mdm, mdm_url=server, mdm_user=p.configuration['mdmUser'], mdm_pass=p.configuration['mdmPassword'])  # NOQA
+    else:
+        models = p.mdm_models(mdm=mdm, mdm_token=p.configuration['mdmToken'])  # NOQA
+
+    expected = collections.Counter(model for _, model in fixtures.mdm_devices())  # NOQA
+    if collections.Counter(models or {}) != expected:
+        raise Exception('Models from /mdm/%s do not match the fixtures: %s' % (path, models))  # NOQA
+    return models
+
+
+BENCHMARKS = [
+    ('software_updates', lambda p: list(p.software_updates())),
+    ('ios_updates', lambda p: list(p.ios_updates(iOS=True, watchOS=True, tvOS=True))),  # NOQA
+    ('list_assets', lambda p: p.list_assets()),
+    ('main_processor', lambda p: p.main_processor(models=MODELS, ipsw=IPSW, mac_updates=MAC_UPDATES, apps=APPS)),  # NOQA
+    ('mdm_jamf', lambda p: mdm_models(p, 'jamf', 'jamf')),
+    ('mdm_jamf_classic', lambda p: mdm_models(p, 'jamf', 'classic')),
+    ('mdm_simplemdm', lambda p: mdm_models(p, 'simplemdm', 'simplemdm')),
+]
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(script, port, *args):
+    '''Starts a server script from this folder in a separate process, so it
+    doesn't compete with precache for the GIL, and waits until it accepts
+    connections.'''
+    cmd = [sys.executable, os.path.join(BENCHMARK_DIR, script),
+           '--port', str(port)] + [str(x) for x in args]
+    server = subprocess.Popen(cmd)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except socket.error:
+            sleep(0.05)
+    server.terminate()
+    raise Exception('Benchmark server did not start')
+
+
+def setting(value):
+    '''Returns a --set value as an integer where possible.'''
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def run(precache, work_dir, benchmark):
+    '''Returns the number of seconds a benchmark took. Output from precache
+    is discarded.'''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            p = precache.PreCache()
+            start = time()
+            benchmark(p)
+            return time() - start
+        finally:
+            os.chdir(cwd)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks precache against a local stand-in server.')  # NOQA
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds to delay every request by.')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='Bytes per second for each response.')
+    parser.add_argument('--products', type=int, default=300,
+                        help='Number of products in the software update catalog.')  # NOQA
+    parser.add_argument('--payload-size', type=int, default=65536,
+                        help='Size in bytes of every package and IPSW file.')  # NOQA
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times each benchmark is run, the fastest run is reported.')  # NOQA
+    parser.add_argument('--only', nargs='+', metavar='benchmark',
+                        choices=[name for name, _ in BENCHMARKS],
+                        help='Only run these benchmarks.')
+    parser.add_argument('--set', nargs='+', default=[], metavar='key=value',
+                        help='Configuration values to use.')
+    parser.add_argument('--output', help='Save the results as JSON.')
+    parser.add_argument('--compare', help='Compare to results saved with --output.')  # NOQA
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='precache-benchmark-')
+    port = free_port()
+    base_url = 'http://127.0.0.1:%s' % port
+    server = None
+    try:
+        fixtures.build(os.path.join(tmp, 'www'), base_url, products=args.products, payload_size=args.payload_size)  # NOQA
+        server_args = ['--root', os.path.join(tmp, 'www'), '--latency', args.latency]  # NOQA
+        if args.bandwidth:
+            server_args.extend(['--bandwidth', args.bandwidth])
+        server = start_server('server.py', port, *server_args)
+
+        # precache reads its configuration from the working directory
+        work_dir = os.path.join(tmp, 'work')
+        state_dir = os.path.join(tmp, 'state')
+        os.makedirs(work_dir)
+        configuration = fixtures.configure(plistlib.readPlist(os.path.join(REPO_DIR, 'com.github.krypted.precache.example-config.plist')), base_url)  # NOQA
+        configuration['cacheServerURL'] = 'http://127.0.0.1'
+        configuration['cacheServerPort'] = port
+        configuration['cacheServers'] = []
+        configuration['destination'] = os.path.join(tmp, 'dest')
+        configuration['stateDirectory'] = state_dir
+        for item in args.set:
+            key, value = item.split('=', 1)
+            configuration[key] = setting(value)
+        plistlib.writePlist(configuration, os.path.join(work_dir, 'com.github.krypted.precache.my-config.plist'))  # NOQA
+
+        sys.path.insert(0, REPO_DIR)
+        import precache
+
+        results = {}
+        for name, benchmark in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            cold = []
+            warm = []
+            for _ in range(args.repeat):
+                for path in [state_dir, configuration['destination']]:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                os.makedirs(configuration['destination'])
+                cold.append(run(precache, work_dir, benchmark))
+                warm.append(run(precache, work_dir, benchmark))
+            results[name] = {'cold': min(cold), 'warm': min(warm)}
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    print '%-18s %10s %10s' % ('benchmark', 'cold (s)', 'warm (s)')
+    for name, _ in BENCHMARKS:
+        if name not in results:
+            continue
+        line = '%-18s %10.3f %10.3f' % (name, results[name]['cold'], results[name]['warm'])  # NOQA
+        if name in previous:
+            line += '   %+.0f%% / %+.0f%%' % tuple((results[name][x] - previous[name][x]) / previous[name][x] * 100 for x in ['cold', 'warm'])  # NOQA
+        print line
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2, sort_keys=True)  # NOQA
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+'''A mock caching server for load testing. It answers HEAD and GET requests
+for caching server URLs (/path?source=host) the same way precache expects
+the caching service to:
+
+- Items that aren't cached are returned with a Content-Type header.
+- Items that are cached are returned without one.
+
+Payloads are generated, every item is --payload-size bytes. An item becomes
+cached once it has been downloaded in full, and --cached sets the fraction
+of items that start out cached. Requests without a source are rejected.
+
+The number of requests, bytes sent and the number of requests in flight are
+recorded. GET /_stats returns them as JSON, POST /_reset clears them along
+with the items cached by downloads.'''
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import zlib
+
+from time import sleep
+from time import time
+from urlparse import parse_qs
+from urlparse import urlparse
+
+
+class Stats(object):
+    '''Counters shared by every request.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_sent = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            # Number of requests that started with this many requests
+            # already in flight.
+            self.concurrency = {}
+            self.started = None
+            self.finished = None
+            self.downloaded = set()
+
+    def begin(self, method):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            self.concurrency[self.in_flight] = self.concurrency.get(self.in_flight, 0) + 1  # NOQA
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if not self.started:
+                self.started = time()
+
+    def end(self, sent=0):
+        with self.lock:
+            self.in_flight -= 1
+            self.bytes_sent += sent
+            self.finished = time()
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'bytes_sent': self.bytes_sent,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'concurrency': self.concurrency,
+                'duration': (self.finished - self.started) if self.started else 0,  # NOQA
+            }
+
+
+class CacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Set by serve()
+    stats = None
+    payload_size = 1048576
+    cached_fraction = 0
+    latency = 0
+    bandwidth = None
+    block = ('precache' * 8192)[:65536]
+
+    def is_cached(self, key):
+        if key in self.stats.downloaded:
+            return True
+        return zlib.crc32(key) % 1000 < self.cached_fraction * 1000
+
+    def item(self):
+        '''Returns the key for the requested item, or None after sending an
+        error if the request isn't for a caching server URL.'''
+        url = urlparse(self.path)
+        source = parse_qs(url.query).get('source')
+        if not source:
+            self.send_error(400, 'No source')
+            return None
+        return '%s%s' % (source[0], url.path)
+
+    def send_headers(self, key, length, status=200, start=None):
+        self.send_response(status)
+        if not self.is_cached(key):
+            self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Last-Modified', 'Wed, 19 Jul 2017 00:00:00 GMT')
+        if start is not None:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, self.payload_size - 1, self.payload_size))  # NOQA
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.stats.begin('HEAD')
+        try:
+            if self.latency:
+                sleep(self.latency)
+            key = self.item()
+            if key:
+                self.send_headers(key, self.payload_size)
+        finally:
+            self.stats.end()
+
+    def do_GET(self):
+        if self.path.startswith('/_stats'):
+            body = json.dumps(self.stats.as_dict())
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.stats.begin('GET')
+        sent = 0
+        try:
+            if self.latency:
+                sleep(self.latency)
+            key = self.item()
+            if not key:
+                return
+
+            # Ranges are only supported from an offset to the end
+            start = 0
+            status = 200
+            requested = self.headers.get('Range')
+            if requested and requested.startswith('bytes=') and requested.endswith('-'):  # NOQA
+                start = int(requested[len('bytes='):-1])
+                if start >= self.payload_size:
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+            self.send_headers(key, self.payload_size - start, status=status, start=start if status == 206 else None)  # NOQA
+
+            begin = time()
+            remaining = self.payload_size - start
+            while remaining > 0:
+                data = self.block[:min(remaining, len(self.block))]
+                self.wfile.write(data)
+                sent += len(data)
+                remaining -= len(data)
+                if self.bandwidth:
+                    delay = sent / float(self.bandwidth) - (time() - begin)
+                    if delay > 0:
+                        sleep(delay)
+
+            with self.stats.lock:
+                self.stats.downloaded.add(key)
+        finally:
+            self.stats.end(sent)
+
+    def do_POST(self):
+        if self.path.startswith('/_reset'):
+            self.stats.reset()
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_error(404, 'Not found')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):  # NOQA
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(port=49672, payload_size=1048576, cached_fraction=0, latency=0, bandwidth=None):  # NOQA
+    '''Runs the mock caching server on port until stopped. payload_size is
+    the size in bytes of every item, cached_fraction the fraction of items
+    that start out cached, latency the number of seconds every request is
+    delayed by, and bandwidth the number of bytes per second each download
+    is sent at.'''
+    CacheHandler.stats = Stats()
+    CacheHandler.payload_size = payload_size
+    CacheHandler.cached_fraction = cached_fraction
+    CacheHandler.latency = latency
+    CacheHandler.bandwidth = bandwidth
+    server = ThreadedServer(('127.0.0.1', port), CacheHandler)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock caching server for load testing.')  # NOQA
+    parser.add_argument('--port', type=int, default=49672)
+    parser.add_argument('--payload-size', type=int, default=1048576,
+                        help='Size in bytes of every item.')
+    parser.add_argument('--cached', type=float, default=0,
+                        help='Fraction of items that start out cached.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to delay every request by.')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='Bytes per second for each download.')
+    args = parser.parse_args()
+    serve(port=args.port, payload_size=args.payload_size, cached_fraction=args.cached, latency=args.latency, bandwidth=args.bandwidth)  # NOQA
+
+
+if __name__ == '__main__':
+    main()
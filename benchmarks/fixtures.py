@@ -0,0 +1,178 @@
+#!/usr/bin/python
+'''Builds the feeds and payloads served by the benchmark server. The
+fixtures have the same layout as the Apple, ipsw.me and apps feeds precache
+reads. Feed URLs point at the benchmark server, while the items to
+download keep their Apple hosts, as precache only fetches those through the
+caching server (which the benchmark server also stands in for):
+
+    catalog.sucatalog                         software update catalog
+    smd/<product id>.smd                      product metadata
+    content/downloads/<product id>/*.pkg      software update packages
+    mesu/ios.xml, mesu/watch/ios.xml,
+    mesu/tv/ios.xml                           MobileAsset feeds
+    ios<version>/<model>/*.zip                OTA updates
+    api/<model>/latest/name                   ipsw.me device descriptions
+    api/<model>/latest/info.json              ipsw.me IPSW information
+    ipsw/*.ipsw                               IPSW files
+    apps.plist                                apps that can be cached
+    apps/*.pkg                                app installers
+    mdm/devices.json                          MDM inventory, served in pages
+                                              by the Jamf and SimpleMDM
+                                              stand-ins in server.py
+'''
+import hashlib
+import json
+import os
+import plistlib
+
+from datetime import datetime
+
+# Models in the MobileAsset feeds, and the models that have IPSW files.
+IOS_MODELS = ['iPad6,7', 'iPad6,8', 'iPad7,3', 'iPad7,4', 'iPhone8,1',
+              'iPhone8,2', 'iPhone9,1', 'iPhone9,2', 'iPhone9,3', 'iPhone9,4',
+              'iPod7,1']
+WATCH_MODELS = ['Watch1,1', 'Watch2,3', 'Watch2,4']
+TV_MODELS = ['AppleTV5,3', 'AppleTV6,2']
+
+# Titles used for software update products, a product of each title is
+# made in turn.
+TITLES = ['macOS Sierra Update', 'Security Update', 'Safari', 'iTunes',
+          'Printer Driver', 'Voice Update', 'Xcode Command Line Tools',
+          'Boot Camp']
+
+# Devices in the MDM inventory, several pages at the default page size.
+MDM_DEVICES = 1050
+
+IOS_VERSION = '10.3.3'
+IOS_BUILD = '14G60'
+
+
+def mdm_devices():
+    '''Returns the id and model of every device in the MDM inventory. Most
+    devices are the first few models, like a real fleet.'''
+    return [(i + 1, IOS_MODELS[int(len(IOS_MODELS) * (float(i) / MDM_DEVICES) ** 2)]) for i in range(MDM_DEVICES)]  # NOQA
+
+
+def write_payload(path, size):
+    '''Writes size bytes to path, returning the SHA1 digest of the file.'''
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    block = ('precache' * 8192)[:65536]
+    digest = hashlib.sha1()
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            data = block[:min(remaining, len(block))]
+            f.write(data)
+            digest.update(data)
+            remaining -= len(data)
+    return digest.hexdigest()
+
+
+def write_plist(data, path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    plistlib.writePlist(data, path)
+
+
+def build(root, base_url, products=300, payload_size=65536):
+    '''Writes the fixtures to root. base_url is the URL of the benchmark
+    server, products is the number of software update products in the
+    catalog, and payload_size is the size in bytes of every package, OTA
+    update and IPSW file.'''
+    base_url = base_url.rstrip('/')
+
+    # Software update catalog, product metadata and packages
+    catalog = {}
+    for i in range(products):
+        product_id = '041-%05d' % i
+        title = TITLES[i % len(TITLES)]
+        package = 'content/downloads/%s/Update%s.pkg' % (product_id, i)
+        catalog[product_id] = {
+            'PostDate': datetime(2015 + (i % 3), 1 + (i % 12), 1 + (i % 28)),
+            'ServerMetadataURL': '%s/smd/%s.smd' % (base_url, product_id),
+            'Packages': [{'URL': 'http://swcdn.apple.com/%s' % package,
+                          'Size': payload_size}],
+        }
+        write_plist({
+            'CFBundleShortVersionString': '1.%s' % i,
+            'localization': {'English': {'title': '%s %s' % (title, i)}},
+        }, os.path.join(root, 'smd', '%s.smd' % product_id))
+        write_payload(os.path.join(root, package), payload_size)
+    write_plist({'Products': catalog}, os.path.join(root, 'catalog.sucatalog'))  # NOQA
+
+    # MobileAsset feeds and OTA updates
+    def mesu(path, models):
+        assets = []
+        for model in models:
+            relative_path = '%s/%s.zip' % (model, model.replace(',', ''))
+            assets.append({
+                'Build': IOS_BUILD,
+                'OSVersion': IOS_VERSION,
+                'SupportedDevices': [model],
+                '__BaseURL': 'http://appldnld.apple.com/ios%s/' % IOS_VERSION,  # NOQA
+                '__CanUseLocalCacheServer': True,
+                '__RelativePath': relative_path,
+            })
+            write_payload(os.path.join(root, 'ios%s' % IOS_VERSION, relative_path), payload_size)  # NOQA
+        write_plist({'Assets': assets}, os.path.join(root, 'mesu', path))
+
+    mesu('ios.xml', IOS_MODELS)
+    mesu(os.path.join('watch', 'ios.xml'), WATCH_MODELS)
+    mesu(os.path.join('tv', 'ios.xml'), TV_MODELS)
+
+    # ipsw.me device descriptions, IPSW information and IPSW files
+    for model in IOS_MODELS + WATCH_MODELS + TV_MODELS:
+        api = os.path.join(root, 'api', model, 'latest')
+        os.makedirs(api)
+        with open(os.path.join(api, 'name'), 'w') as f:
+            f.write('Device %s' % model)
+        ipsw = '%s_%s_%s_Restore.ipsw' % (model, IOS_VERSION, IOS_BUILD)
+        sha1sum = write_payload(os.path.join(root, 'ipsw', ipsw), payload_size)  # NOQA
+        with open(os.path.join(api, 'info.json'), 'w') as f:
+            json.dump([{
+                'buildid': IOS_BUILD,
+                'device': 'Device %s' % model,
+                'releasedate': '2017-07-19',
+                'sha1sum': sha1sum,
+                'url': 'http://appldnld.apple.com/ipsw/%s' % ipsw,
+                'version': IOS_VERSION,
+            }], f)
+
+    # Apps that can be cached
+    apps = {}
+    for name, group in [('Xcode', 'app'), ('Server', 'app'),
+                        ('Sierra', 'installer')]:
+        apps[name] = {
+            'type': group,
+            'url': 'http://osxapps.itunes.apple.com/apps/%s.pkg' % name,
+            'version': '1.0',
+        }
+        write_payload(os.path.join(root, 'apps', '%s.pkg' % name), payload_size)  # NOQA
+    write_plist(apps, os.path.join(root, 'apps.plist'))
+
+    # MDM inventory
+    os.makedirs(os.path.join(root, 'mdm'))
+    with open(os.path.join(root, 'mdm', 'devices.json'), 'w') as f:
+        json.dump([{'id': device_id, 'model': model} for device_id, model in mdm_devices()], f)  # NOQA
+
+
+def configure(configuration, base_url):
+    '''Returns a copy of a precache configuration with every feed pointing
+    at the benchmark server.'''
+    base_url = base_url.rstrip('/')
+    configuration = dict(configuration)
+    configuration['appsCanCache'] = '%s/apps.plist' % base_url
+    configuration['iosBaseURL'] = '%s/mesu/' % base_url
+    configuration['iosFeeds'] = {'ios': 'ios.xml',
+                                 'tv': 'tv/ios.xml',
+                                 'watch': 'watch/ios.xml'}
+    configuration['ipswBaseURL'] = '%s/api' % base_url
+    configuration['mdmPassword'] = 'benchmark'
+    configuration['mdmServer'] = '%s/mdm/jamf' % base_url
+    configuration['mdmToken'] = 'benchmark'
+    configuration['mdmUser'] = 'benchmark'
+    configuration['softwareUpdateFeed'] = {'all': 'catalog.sucatalog'}
+    configuration['simpleMDMURL'] = '%s/mdm/simplemdm/devices' % base_url
+    configuration['swuBaseURL'] = '%s/' % base_url
+    return configuration
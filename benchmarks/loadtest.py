@@ -0,0 +1,141 @@
+#!/usr/bin/python
+'''Load tests the probe and download paths of precache against the mock
+caching server in cache_server.py. A number of item URLs are made with
+reformat_url(), then:
+
+- probe() checks the cache state of every item, measuring HEAD requests
+  per second.
+- download_all() downloads every item that isn't cached, measuring the
+  throughput.
+
+The most requests the mock server had in flight at once is reported for
+each, which shows how well the configured workers and maxConnections are
+used. Configuration keys can be changed with --set key=value, for example:
+
+    ./loadtest.py --items 2000 --cached 0.5 --set probeWorkers=32
+'''
+import argparse
+import json
+import os
+import plistlib
+import shutil
+import sys
+import tempfile
+
+from time import time
+
+from benchmark import REPO_DIR
+from benchmark import free_port
+from benchmark import setting
+from benchmark import start_server
+
+HOSTS = ['swcdn.apple.com', 'appldnld.apple.com', 'osxapps.itunes.apple.com',
+         'updates-http.cdn-apple.com']
+
+
+def server_request(p, base_url, method, path):
+    return p.http_request(method, '%s%s' % (base_url, path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests precache against a mock caching server.')  # NOQA
+    parser.add_argument('--items', type=int, default=500,
+                        help='Number of items to probe and download.')
+    parser.add_argument('--payload-size', type=int, default=1048576,
+                        help='Size in bytes of every item.')
+    parser.add_argument('--cached', type=float, default=0,
+                        help='Fraction of items that start out cached.')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds to delay every request by.')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='Bytes per second for each download.')
+    parser.add_argument('--set', nargs='+', default=[], metavar='key=value',
+                        help='Configuration values to use.')
+    parser.add_argument('--output', help='Save the results as JSON.')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='precache-loadtest-')
+    port = free_port()
+    base_url = 'http://127.0.0.1:%s' % port
+    server_args = ['--payload-size', args.payload_size, '--cached', args.cached, '--latency', args.latency]  # NOQA
+    if args.bandwidth:
+        server_args.extend(['--bandwidth', args.bandwidth])
+    server = start_server('cache_server.py', port, *server_args)
+    cwd = os.getcwd()
+    try:
+        # precache reads its configuration from the working directory
+        configuration = plistlib.readPlist(os.path.join(REPO_DIR, 'com.github.krypted.precache.example-config.plist'))  # NOQA
+        configuration['cacheServerURL'] = 'http://127.0.0.1'
+        configuration['cacheServerPort'] = port
+        configuration['cacheServers'] = []
+        configuration['destination'] = os.path.join(tmp, 'dest')
+        configuration['stateDirectory'] = os.path.join(tmp, 'state')
+        for item in args.set:
+            key, value = item.split('=', 1)
+            configuration[key] = setting(value)
+        plistlib.writePlist(configuration, os.path.join(tmp, 'com.github.krypted.precache.my-config.plist'))  # NOQA
+        os.chdir(tmp)
+
+        sys.path.insert(0, REPO_DIR)
+        import precache
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            p = precache.PreCache()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        # Items are spread over the hosts the caching server fetches from,
+        # as downloads are limited per host.
+        urls = [p.reformat_url('http://%s/content/downloads/loadtest/Item%05d.pkg' % (HOSTS[i % len(HOSTS)], i)) for i in range(args.items)]  # NOQA
+        results = {}
+
+        # Probe
+        server_request(p, base_url, 'POST', '/_reset')
+        start = time()
+        cached = p.probe(urls)
+        elapsed = time() - start
+        stats = server_request(p, base_url, 'GET', '/_stats').json()
+        results['probe'] = {
+            'requests': stats['requests'].get('HEAD', 0),
+            'seconds': elapsed,
+            'requests_per_second': stats['requests'].get('HEAD', 0) / elapsed,  # NOQA
+            'max_in_flight': stats['max_in_flight'],
+            'cached': len([x for x in cached.values() if x]),
+        }
+
+        # Download
+        uncached = [url for url in urls if not cached[url]]
+        server_request(p, base_url, 'POST', '/_reset')
+        start = time()
+        transfers = p.download_all(uncached)
+        elapsed = time() - start
+        stats = server_request(p, base_url, 'GET', '/_stats').json()
+        results['download'] = {
+            'items': len(uncached),
+            'failed': len([x for x in transfers if x.error]),
+            'bytes': stats['bytes_sent'],
+            'seconds': elapsed,
+            'bytes_per_second': stats['bytes_sent'] / elapsed if elapsed else 0,  # NOQA
+            'max_in_flight': stats['max_in_flight'],
+        }
+    finally:
+        os.chdir(cwd)
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    probe = results['probe']
+    download = results['download']
+    print 'Probe:    %s HEAD requests in %.2fs, %.0f/s, %s in flight at most, %s cached' % (probe['requests'], probe['seconds'], probe['requests_per_second'], probe['max_in_flight'], probe['cached'])  # NOQA
+    print 'Download: %s items (%s failed), %.1f MB in %.2fs, %.1f MB/s, %s in flight at most' % (download['items'], download['failed'], download['bytes'] / 1048576.0, download['seconds'], download['bytes_per_second'] / 1048576.0, download['max_in_flight'])  # NOQA
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2, sort_keys=True)  # NOQA
+
+
+if __name__ == '__main__':
+    main()
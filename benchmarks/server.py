@@ -0,0 +1,177 @@
+#!/usr/bin/python
+'''A local stand-in for the Apple, ipsw.me and caching servers, serving the
+files in a fixtures directory. Query strings are ignored, so caching server
+URLs (/path?source=host) are served from the same files as the feeds.
+Every response can be delayed by a fixed latency and limited to a
+bandwidth, and conditional requests (If-Modified-Since) are answered with
+304 Not Modified when a file hasn't changed.
+
+It also stands in for the MDM servers, serving the devices in
+mdm/devices.json in pages:
+
+    /mdm/jamf       Jamf Pro API (a token from /api/v1/auth/token, then
+                    /api/v2/mobile-devices by page) and the Classic API
+    /mdm/classic    a Jamf server with only the Classic API
+                    (/JSSResource/mobiledevices, every device at once)
+    /mdm/simplemdm  SimpleMDM devices API (/devices, with a limit and a
+                    starting_after cursor)
+'''
+import argparse
+import json
+import os
+import posixpath
+import SimpleHTTPServer
+import SocketServer
+import urllib
+
+from StringIO import StringIO
+from time import sleep
+from time import time
+from urlparse import parse_qs
+from urlparse import urlparse
+
+# Token handed out by the Jamf stand-in
+TOKEN = 'benchmark'
+
+
+class FixtureHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Set by serve()
+    root = None
+    latency = 0
+    bandwidth = None
+
+    def translate_path(self, path):
+        path = urllib.unquote(path.split('?', 1)[0].split('#', 1)[0])
+        parts = [x for x in posixpath.normpath(path).split('/') if x not in ('', '.', '..')]  # NOQA
+        return os.path.join(self.root, *parts)
+
+    def mdm(self):
+        '''Returns the status and JSON response for a request to one of the
+        MDM stand-ins.'''
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())  # NOQA
+        with open(os.path.join(self.root, 'mdm', 'devices.json')) as f:
+            devices = json.load(f)
+
+        if self.command == 'POST' and url.path == '/mdm/jamf/api/v1/auth/token':  # NOQA
+            return 200, {'token': TOKEN, 'expires': '2099-01-01T00:00:00.000Z'}  # NOQA
+
+        if self.command == 'GET' and url.path == '/mdm/jamf/api/v2/mobile-devices':  # NOQA
+            if self.headers.get('Authorization') != 'Bearer %s' % TOKEN:
+                return 401, {'httpStatus': 401, 'errors': []}
+            size = int(query.get('page-size', 100))
+            start = int(query.get('page', 0)) * size
+            return 200, {
+                'totalCount': len(devices),
+                'results': [{'id': str(x['id']), 'modelIdentifier': x['model']} for x in devices[start:start + size]],  # NOQA
+            }
+
+        if self.command == 'GET' and url.path in ['/mdm/jamf/JSSResource/mobiledevices', '/mdm/classic/JSSResource/mobiledevices']:  # NOQA
+            return 200, {'mobile_devices': [{'id': x['id'], 'model_identifier': x['model']} for x in devices]}  # NOQA
+
+        if self.command == 'GET' and url.path == '/mdm/simplemdm/devices':
+            limit = int(query.get('limit', 10))
+            after = int(query.get('starting_after', 0))
+            page = [x for x in devices if x['id'] > after][:limit]
+            return 200, {
+                'data': [{'id': x['id'], 'type': 'device', 'attributes': {'product_name': x['model']}} for x in page],  # NOQA
+                'has_more': bool(page) and page[-1]['id'] < devices[-1]['id'],  # NOQA
+            }
+
+        return 404, {'errors': [{'title': 'Not found'}]}
+
+    def send_head(self):
+        if self.latency:
+            sleep(self.latency)
+
+        if self.path.startswith('/mdm/'):
+            status, response = self.mdm()
+            body = json.dumps(response)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            return StringIO(body)
+
+        if self.command == 'POST':
+            self.send_error(405, 'Method not allowed')
+            return None
+
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return None
+
+        modified = self.date_time_string(int(os.stat(path).st_mtime))
+        if self.headers.get('If-Modified-Since') == modified:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        f = open(path, 'rb')
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))  # NOQA
+        self.send_header('Last-Modified', modified)
+        self.end_headers()
+        return f
+
+    def do_POST(self):
+        # Only the Jamf token is requested with POST
+        return self.do_GET()
+
+    def copyfile(self, source, outputfile):
+        if not self.bandwidth:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self, source, outputfile)  # NOQA
+
+        # Send a tenth of a second's worth of data at a time
+        chunk_size = max(1, int(self.bandwidth / 10))
+        start = time()
+        sent = 0
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            outputfile.write(data)
+            sent += len(data)
+            delay = sent / float(self.bandwidth) - (time() - start)
+            if delay > 0:
+                sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(root, port=8765, latency=0, bandwidth=None):
+    '''Serves the files in root on port until stopped. latency is the
+    number of seconds every request is delayed by, bandwidth is the number
+    of bytes per second each response is sent at.'''
+    FixtureHandler.root = os.path.abspath(root)
+    FixtureHandler.latency = latency
+    FixtureHandler.bandwidth = bandwidth
+    server = ThreadedServer(('127.0.0.1', port), FixtureHandler)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves benchmark fixtures.')  # NOQA
+    parser.add_argument('--root', required=True, help='Fixtures directory.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to delay every request by.')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='Bytes per second for each response.')
+    args = parser.parse_args()
+    serve(args.root, port=args.port, latency=args.latency, bandwidth=args.bandwidth)  # NOQA
+
+
+if __name__ == '__main__':
+    main()
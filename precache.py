@@ -1,28 +1,40 @@
 #!/usr/bin/python
 import argparse
 import collections
+import cProfile
+import errno
 import hashlib
+import json
 import logging
 import os
+import pstats
+import re
 import subprocess
 import sys
+import threading
 # import xml.etree.ElementTree as ET
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
     from requests.auth import HTTPBasicAuth
 except:
     print 'Please install the requests module: sudo pip install requests'  # NOQA
     print 'Information about the module: http://docs.python-requests.org/en/master/'  # NOQA
     sys.exit(1)
 
+from contextlib import contextmanager
 from datetime import datetime
+from datetime import timedelta
 from logging.handlers import RotatingFileHandler
+from multiprocessing.pool import ThreadPool
 from operator import attrgetter
 from plistlib import readPlist
 from plistlib import readPlistFromString
-from random import uniform
+from StringIO import StringIO
 from time import sleep
+from time import time
+from urlparse import parse_qs
 from urlparse import urljoin
 from urlparse import urlparse
 
@@ -37,8 +49,247 @@ __maintainer__ = 'Carl Windus: https://github.com/carlashley/precache_dev'
 __status__ = 'development'
 
 
+def ensure_dir(path):
+    '''Creates the folder path and any parent folders if they don't exist.
+    Several threads can create the same folder at once, so a folder created
+    by another thread in the meantime isn't an error.'''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+class PersistentCache():
+    def __init__(self, path, max_entries=None, ttl=None):
+        '''A small JSON backed key/value store that persists between runs.
+        Once max_entries is exceeded the least recently used entries are
+        evicted, and entries older than ttl (seconds) are treated as
+        missing.'''
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.load()
+
+    def get(self, key, default=None):
+        '''Returns the value for key, marking it as most recently used.'''
+        with self.lock:
+            try:
+                stored, value = self.entries.pop(key)
+            except KeyError:
+                return default
+
+            if self.ttl and time() - stored > self.ttl:
+                return default
+
+            self.entries[key] = (stored, value)
+            return value
+
+    def load(self):
+        '''Loads entries from disk, oldest first. A missing or unreadable
+        file results in an empty cache.'''
+        try:
+            with open(self.path, 'r') as f:
+                for key, stored, value in json.load(f):
+                    self.entries[key] = (stored, value)
+        except:
+            pass
+
+    def save(self):
+        '''Writes entries to disk. The file is written to a temporary path
+        first so an interrupted run can't leave a truncated cache behind.'''
+        with self.lock:
+            data = [[key, stored, value] for key, (stored, value) in self.entries.items()]  # NOQA
+            try:
+                ensure_dir(os.path.dirname(self.path))
+                with open('%s.tmp' % self.path, 'w') as f:
+                    json.dump(data, f)
+                os.rename('%s.tmp' % self.path, self.path)
+            except Exception as e:
+                logging.getLogger('precache').debug('Unable to save %s: %s' % (self.path, e))  # NOQA
+
+    def set(self, key, value):
+        '''Stores value for key, evicting the least recently used entries if
+        the cache is full.'''
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time(), value)
+            if self.max_entries:
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+
+class Metrics():
+    # Help text for each counter, as shown by Prometheus
+    counter_help = {
+        'cache_hits': 'Items already cached on a caching server.',
+        'cache_misses': 'Items not yet cached on a caching server.',
+        'download_failures': 'Downloads that failed.',
+        'downloads': 'Downloads completed.',
+        'feeds_not_modified': 'Feeds that had not changed since they were last fetched.',  # NOQA
+        'http_bytes': 'Bytes downloaded.',
+        'http_errors': 'HTTP requests that failed.',
+        'http_requests': 'HTTP requests made.',
+    }
+
+    def __init__(self, buckets=None, profile=False):
+        '''Records how long each phase of a run takes, counters such as the
+        number of HTTP requests made, and a histogram of the latency of HTTP
+        requests to each host. Histogram buckets are upper bounds in
+        seconds. If profile is True, phases are also run under cProfile.'''
+        if not buckets:
+            buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+        self.buckets = buckets
+        self.profile = profile
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def as_dict(self):
+        '''Returns the metrics in a form that can be written as JSON.'''
+        with self.lock:
+            return {
+                'started': self.started,
+                'duration': time() - self.started,
+                'phases': [{'phase': name, 'item': item, 'count': count, 'seconds': seconds} for (name, item), (count, seconds) in self.phases.items()],  # NOQA
+                'counters': dict(self.counters),
+                'latency': dict((host, {'buckets': zip(self.buckets, histogram['buckets']), 'count': histogram['count'], 'sum': histogram['sum']}) for host, histogram in self.latencies.items()),  # NOQA
+            }
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, host, seconds):
+        '''Adds the latency of a request to the histogram for host.'''
+        with self.lock:
+            histogram = self.latencies.setdefault(host, {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0})  # NOQA
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextmanager
+    def phase(self, name, item=None):
+        '''Times the enclosed block as a run of the named phase, item is
+        what the phase is working on, such as a feed URL. Runs of the same
+        phase are added together, including runs in other threads. Yields a
+        dictionary with the seconds taken set once the block ends.
+        When profiling, the outermost phase in each thread is profiled, and
+        the profiles for runs of the same phase are added together.'''
+        timer = {'seconds': 0}
+        profiler = None
+        if self.profile and not getattr(self.local, 'profiling', False):
+            self.local.profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = time()
+        try:
+            yield timer
+        finally:
+            timer['seconds'] = time() - start
+            if profiler:
+                profiler.disable()
+                self.local.profiling = False
+            with self.lock:
+                count, seconds = self.phases.get((name, item), (0, 0))
+                self.phases[(name, item)] = (count + 1, seconds + timer['seconds'])  # NOQA
+                if profiler:
+                    if (name, item) in self.profiles:
+                        self.profiles[(name, item)].add(profiler)
+                    else:
+                        self.profiles[(name, item)] = pstats.Stats(profiler)
+
+    def prometheus(self):
+        '''Returns the metrics in the Prometheus text format, as read by the
+        node_exporter textfile collector.'''
+        def labels(**kwargs):
+            escaped = ['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in sorted(kwargs.items()) if value is not None]  # NOQA
+            return '{%s}' % ','.join(escaped) if escaped else ''
+
+        metrics = self.as_dict()
+        lines = [
+            '# HELP precache_last_run_timestamp_seconds Time the last run started.',  # NOQA
+            '# TYPE precache_last_run_timestamp_seconds gauge',
+            'precache_last_run_timestamp_seconds %s' % metrics['started'],
+            '# HELP precache_run_duration_seconds Duration of the last run.',
+            '# TYPE precache_run_duration_seconds gauge',
+            'precache_run_duration_seconds %s' % metrics['duration'],
+            '# HELP precache_phase_seconds Time spent in each phase of the last run.',  # NOQA
+            '# TYPE precache_phase_seconds gauge',
+        ]
+        for phase in metrics['phases']:
+            lines.append('precache_phase_seconds%s %s' % (labels(phase=phase['phase'], item=phase['item']), phase['seconds']))  # NOQA
+        lines.extend([
+            '# HELP precache_phase_runs Number of times each phase ran in the last run.',  # NOQA
+            '# TYPE precache_phase_runs gauge',
+        ])
+        for phase in metrics['phases']:
+            lines.append('precache_phase_runs%s %s' % (labels(phase=phase['phase'], item=phase['item']), phase['count']))  # NOQA
+        for name, value in sorted(metrics['counters'].items()):
+            lines.extend([
+                '# HELP precache_%s_total %s' % (name, self.counter_help.get(name, name.replace('_', ' ').capitalize() + '.')),  # NOQA
+                '# TYPE precache_%s_total counter' % name,
+                'precache_%s_total %s' % (name, value),
+            ])
+        lines.extend([
+            '# HELP precache_http_request_duration_seconds Latency of HTTP requests to each host in the last run.',  # NOQA
+            '# TYPE precache_http_request_duration_seconds histogram',
+        ])
+        for host, histogram in sorted(metrics['latency'].items()):
+            for bound, count in histogram['buckets']:
+                lines.append('precache_http_request_duration_seconds_bucket%s %s' % (labels(host=host, le=bound), count))  # NOQA
+            lines.append('precache_http_request_duration_seconds_bucket%s %s' % (labels(host=host, le='+Inf'), histogram['count']))  # NOQA
+            lines.append('precache_http_request_duration_seconds_sum%s %s' % (labels(host=host), histogram['sum']))  # NOQA
+            lines.append('precache_http_request_duration_seconds_count%s %s' % (labels(host=host), histogram['count']))  # NOQA
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        '''Clears all metrics, ready for a new run.'''
+        with self.lock:
+            self.started = time()
+            self.phases = collections.OrderedDict()
+            self.profiles = collections.OrderedDict()
+            self.counters = {}
+            self.latencies = {}
+
+    def write_profiles(self, directory, top=20):
+        '''Writes the profile of each phase to a pstats file in directory,
+        returning a dictionary of the file written for each phase and a
+        summary of the top functions by cumulative time.'''
+        with self.lock:
+            profiles = self.profiles.items()
+
+        ensure_dir(directory)
+        summaries = collections.OrderedDict()
+        for (name, item), stats in profiles:
+            if item:
+                name = '%s-%s' % (name, re.sub(r'[^A-Za-z0-9.-]+', '_', item)[-80:])  # NOQA
+            path = os.path.join(directory, '%s.pstats' % name)
+            stats.dump_stats(path)
+            stats.stream = StringIO()
+            stats.sort_stats('cumulative').print_stats(top)
+            summaries[path] = stats.stream.getvalue()
+        return summaries
+
+    def write(self, json_path, prometheus_path):
+        '''Writes the metrics as JSON and in the Prometheus text format. Each
+        file is written to a temporary path first, so a partial file is
+        never read.'''
+        for path, data in [(json_path, json.dumps(self.as_dict(), indent=2, sort_keys=True)),  # NOQA
+                           (prometheus_path, self.prometheus())]:
+            ensure_dir(os.path.dirname(path))
+            with open('%s.tmp' % path, 'w') as f:
+                f.write(data)
+            os.rename('%s.tmp' % path, path)
+
+
 class PreCache():
-    def __init__(self, destination=None, dry_run=None, server=None, use_config=None):  # NOQA
+    def __init__(self, destination=None, dry_run=None, server=None, use_config=None, verify=None, time_budget=None, byte_budget=None, profile=None):  # NOQA
         '''Initialises the class with supplied arguments, and loads
         configuration information if present in the config plist.'''
         # Logging
@@ -50,6 +301,10 @@ class PreCache():
         self.fh.setFormatter(self.log_format)
         self.log.addHandler(self.fh)
 
+        # Timings and counters for the run, written to metricsDirectory at
+        # the end of the run.
+        self.metrics = Metrics()
+
         # Configuration variables
         # This is an example configuration file, please copy this plist and
         # modify it with your own configuration data, and update this variable
@@ -76,6 +331,14 @@ class PreCache():
         else:
             self.dry_run = False
 
+        # Forces digests of existing files to be calculated again rather than
+        # using the stored digest.
+        if verify:
+            self.verify = True
+            self.log.debug('Verify enabled')
+        else:
+            self.verify = False
+
         # Storage destination for downloaded items
         if destination:
             self.destination = destination
@@ -87,24 +350,220 @@ class PreCache():
         self.log.debug('Output destination: %s' % self.destination)
 
         try:
-            self.user_agent = '%s/%s' % (configuration['userAgentString'], __version__)  # NOQA
+            self.user_agent = '%s/%s' % (self.configuration['userAgentString'], __version__)  # NOQA
         except:
             self.user_agent = 'precache/%s' % __version__
         self.log.debug('User Agent: %s' % self.user_agent)
 
-        self.write_out('Locating caching/tetherator server')
-        if server:
-            self.server = self.valid_server(server)
+        # Number of concurrent workers used when fetching product metadata
+        # from the sucatalog.
+        try:
+            self.metadata_workers = int(self.configuration['metadataWorkers'])  # NOQA
+        except:
+            self.metadata_workers = 8
+        self.log.debug('Metadata workers: %s' % self.metadata_workers)
+
+        # Number of concurrent downloads, and the number of those that can
+        # be made to any one host at the same time.
+        try:
+            self.download_workers = int(self.configuration['downloadWorkers'])  # NOQA
+        except:
+            self.download_workers = 4
+        self.log.debug('Download workers: %s' % self.download_workers)
+
+        try:
+            self.downloads_per_host = int(self.configuration['downloadsPerHost'])  # NOQA
+        except:
+            self.downloads_per_host = 2
+        self.log.debug('Downloads per host: %s' % self.downloads_per_host)
+
+        self.host_slots = {}
+        self.host_slots_lock = threading.Lock()
+
+        # Number of seconds downloads can run for. No new downloads are
+        # started once this has passed.
+        if time_budget:
+            self.time_budget = time_budget
+        else:
+            try:
+                self.time_budget = int(self.configuration['downloadTimeBudget'])  # NOQA
+            except:
+                self.time_budget = None
+        self.log.debug('Download time budget: %s' % self.time_budget)
+        self.deadline = None
+
+        # Number of concurrent requests used to check if items are already
+        # cached. Results are kept for the life of this instance.
+        try:
+            self.probe_workers = int(self.configuration['probeWorkers'])
+        except:
+            self.probe_workers = 16
+        self.log.debug('Probe workers: %s' % self.probe_workers)
+
+        self.cache_state = {}
+        self.content_lengths = {}
+        self.cache_state_lock = threading.Lock()
+
+        # Number of bytes that can be downloaded by a run, so a large run
+        # doesn't evict items cached previously. Items are kept in priority
+        # order until the budget is used.
+        if byte_budget:
+            self.byte_budget = byte_budget
+        else:
+            try:
+                self.byte_budget = int(self.configuration['downloadByteBudget'])  # NOQA
+            except:
+                self.byte_budget = None
+        self.log.debug('Download byte budget: %s' % self.byte_budget)
+
+        # Speed of the network link in Mbit/s, used to estimate how long
+        # downloads will take.
+        try:
+            self.link_speed = float(self.configuration['linkSpeed'])
+        except:
+            self.link_speed = 100
+        self.log.debug('Link speed: %s' % self.link_speed)
+
+        # Size of each block read from the network when downloading.
+        self.chunk_size = 1048576
+
+        # A single HTTP session is shared by every request made, so
+        # connections to the caching server and Apple are kept alive and
+        # reused instead of being set up for each request.
+        try:
+            self.timeout = int(self.configuration['httpTimeout'])
+        except:
+            self.timeout = 10
+        self.log.debug('HTTP timeout: %s' % self.timeout)
+
+        # Limit on the number of HTTP requests in flight at any one time,
+        # across every concurrent stage of a run.
+        try:
+            self.max_connections = int(self.configuration['maxConnections'])  # NOQA
+        except:
+            self.max_connections = 32
+        self.log.debug('Max connections: %s' % self.max_connections)
+        self.http_slots = threading.BoundedSemaphore(self.max_connections)
+
+        self.session = requests.Session()
+        self.session.headers.update({'user-agent': self.user_agent})
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(10, self.metadata_workers, self.download_workers, self.probe_workers))  # NOQA
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Local storage for data that is kept between runs.
+        try:
+            self.state_dir = self.configuration['stateDirectory']
+        except:
+            self.state_dir = '/tmp/precache'
+        self.log.debug('State directory: %s' % self.state_dir)
+
+        try:
+            self.metrics_dir = self.configuration['metricsDirectory']
+        except:
+            self.metrics_dir = self.state_dir
+        self.log.debug('Metrics directory: %s' % self.metrics_dir)
+
+        # Each phase can be run under cProfile, with the stats for each
+        # phase written to profileDirectory at the end of the run.
+        if profile:
+            self.metrics.profile = True
         else:
             try:
-                self.server = self.valid_server('%s:%s' % (self.configuration['cacheServerURL'], self.configuration['cacheServerPort']))  # NOQA
+                self.metrics.profile = bool(self.configuration['profile'])
             except:
-                self.server = self.valid_server(self.cache_server())
-        self.log.info('Caching server: %s' % self.server)
+                self.metrics.profile = False
+        self.log.debug('Profile: %s' % self.metrics.profile)
+
+        try:
+            self.profile_dir = self.configuration['profileDirectory']
+        except:
+            self.profile_dir = os.path.join(self.state_dir, 'profiles')
+
+        try:
+            self.profile_top = int(self.configuration['profileTopN'])
+        except:
+            self.profile_top = 20
+
+        # Product metadata (title, version) never changes once a product is
+        # published, so it only needs to be fetched once per product id.
+        try:
+            metadata_cache_size = int(self.configuration['metadataCacheSize'])
+        except:
+            metadata_cache_size = 5000
+        self.metadata_cache = PersistentCache(os.path.join(self.state_dir, 'metadata.json'), max_entries=metadata_cache_size)  # NOQA
+
+        # Validators (ETag/Last-Modified) for each feed, used to avoid
+        # downloading feeds that haven't changed since the last run. Parsed
+        # feeds are also kept for the life of this instance.
+        self.feed_cache = PersistentCache(os.path.join(self.state_dir, 'feeds.json'), max_entries=100)  # NOQA
+        self.parsed_feeds = {}
+
+        # Assets loaded from each source (feed), and how long each took to
+        # load. Sources are only loaded when something needs them.
+        self.sources = {}
+        self.source_timings = collections.OrderedDict()
+
+        # Daemon mode settings, the URLs that have already been processed are
+        # kept so only new items are cached after a restart.
+        try:
+            self.poll_interval = int(self.configuration['pollInterval'])
+        except:
+            self.poll_interval = 900
+        self.seen_urls = PersistentCache(os.path.join(self.state_dir, 'seen.json'), max_entries=20000)  # NOQA
+
+        # Digests of files in the destination, along with the size, mtime and
+        # inode of the file when the digest was calculated.
+        self.digest_cache = PersistentCache(os.path.join(self.state_dir, 'digests.json'), max_entries=1000)  # NOQA
+
+        # Human readable names for device models from ipsw.me, these rarely
+        # change so are kept for modelNamesTTL seconds.
+        try:
+            model_names_ttl = int(self.configuration['modelNamesTTL'])
+        except:
+            model_names_ttl = 604800
+        self.model_names = PersistentCache(os.path.join(self.state_dir, 'models.json'), ttl=model_names_ttl)  # NOQA
+
+        # Device counts from the MDM are kept for mdmCacheTTL seconds, so
+        # the inventory isn't requested in full on every run.
+        try:
+            mdm_cache_ttl = int(self.configuration['mdmCacheTTL'])
+        except:
+            mdm_cache_ttl = 3600
+        self.mdm_cache = PersistentCache(os.path.join(self.state_dir, 'mdm.json'), ttl=mdm_cache_ttl)  # NOQA
+
+        # Number of devices requested in each page of the MDM inventory.
+        try:
+            self.mdm_page_size = int(self.configuration['mdmPageSize'])
+        except:
+            self.mdm_page_size = 100
+        self.log.debug('MDM page size: %s' % self.mdm_page_size)
+
+        # Items are cached on every server found. The first server is the
+        # primary, it's used for the URLs in a plan and is the only server
+        # IPSW files are saved from.
+        self.write_out('Locating caching/tetherator server')
+        with self.metrics.phase('server_discovery'):
+            if server:
+                if isinstance(server, basestring):
+                    server = [server]
+                self.servers = [self.valid_server(x) for x in server]
+            else:
+                try:
+                    self.servers = [self.valid_server(x) for x in self.configuration['cacheServers']]  # NOQA
+                    if not self.servers:
+                        raise Exception('No caching servers configured.')
+                except:
+                    try:
+                        self.servers = [self.valid_server('%s:%s' % (self.configuration['cacheServerURL'], self.configuration['cacheServerPort']))]  # NOQA
+                    except:
+                        self.servers = [self.valid_server(x) for x in self.cache_server()]  # NOQA
+        self.server = self.servers[0]
+        self.log.info('Caching servers: %s' % ', '.join(self.servers))
 
         # Update location and destination.
-        self.write_out('Locating caching/tetherator server %s. Destination: %s' % (self.server, self.destination))  # NOQA
-        print ''
+        self.write_out('Locating caching/tetherator server %s. Destination: %s' % (', '.join(self.servers), self.destination))  # NOQA
+        sys.stderr.write('\n')
 
         self.mac_model = self.hardware_model()
         self.sucatalog = urljoin(self.configuration['swuBaseURL'], self.configuration['softwareUpdateFeed']['all'])  # NOQA
@@ -118,6 +577,12 @@ class PreCache():
         # Models that have ipsw files downloadable from Apple
         self.ipsw_capable = ['AppleTV', 'iPad', 'iPhone', 'iPod']
 
+        # Base URL for the ipsw.me API
+        try:
+            self.ipsw_base_url = self.configuration['ipswBaseURL'].rstrip('/')
+        except:
+            self.ipsw_base_url = 'https://api.ipsw.me/v2.1'
+
         # Source URLs that apple uses
         self.apple_sources = ['appldnld.apple.com', 'mesu.apple.com', 'osxapps.itunes.apple.com', 'swcdn.apple.com', 'swscan.apple.com']  # NOQA
         # Named Tuple for the item. This is as wide catching as possible.
@@ -131,6 +596,20 @@ class PreCache():
                                                       'release_date',
                                                       'sha_digest'])
 
+        # Named Tuple for a URL that has been selected for caching.
+        self.WorkItem = collections.namedtuple('WorkItem', ['url',
+                                                            'asset',
+                                                            'reasons',
+                                                            'weight'])
+
+        # Named Tuple for the outcome of a download.
+        self.Transfer = collections.namedtuple('Transfer', ['url',
+                                                            'output_file',
+                                                            'size',
+                                                            'duration',
+                                                            'digest',
+                                                            'error'])
+
         # Stops models/ipsw files/apps etc being used from the configuration
         # file if this is being used with arguments
         if use_config:
@@ -140,21 +619,37 @@ class PreCache():
 
     def already_cached(self, asset_url):
         '''Checks if an item is already cached. This is indicated in the
-        headers of the file being checked.'''
+        headers of the file being checked. Each URL is only checked once per
+        run, the result (and the Content-Length of the item) is remembered for
+        later calls.'''
+        with self.cache_state_lock:
+            if asset_url in self.cache_state:
+                return self.cache_state[asset_url]
+
+        size = None
         try:
-            req = requests.head(asset_url, headers={'user-agent': self.user_agent})  # NOQA
+            req = self.http_request('HEAD', asset_url)
+            if req.headers.get('Content-Length') is not None:
+                size = int(req.headers['Content-Length'])
             if req.headers.get('Content-Type') is not None:
                 # Item is not in cache
                 self.log.debug('Not in cache: %s' % asset_url)
-                return False
+                self.metrics.increment('cache_misses')
+                cached = False
             else:
                 # Item is already cached
                 self.log.info('Already in cache: %s' % asset_url)
-                return True
+                self.metrics.increment('cache_hits')
+                cached = True
         except:
             # In case there is an error, we should return false anyway as there
             # is no harm in re-downloading the item if it's already downloaded.
-            return False
+            cached = False
+
+        with self.cache_state_lock:
+            self.cache_state[asset_url] = cached
+            self.content_lengths[asset_url] = size
+        return cached
 
     def app_updates(self):
         '''Returns a generator object with all macOS apps that we can cache.
@@ -190,8 +685,52 @@ class PreCache():
             sha_digest=sha_digest
         )
 
+    def budget_plan(self, plan, server=None):
+        '''Returns the work items in a plan that fit in the byte budget. The
+        size of each URL is the Content-Length returned when probing the
+        caching server, only URLs that aren't already cached count towards
+        the budget. Items are kept in plan order, once one doesn't fit, it
+        and every uncached item after it are left out. The total size of
+        each group in the plan is printed, along with what the budget left
+        out and server if supplied.'''
+        self.probe(plan.keys())
+        budgeted = collections.OrderedDict()
+        totals = collections.OrderedDict()
+        used = 0
+        skipped = 0
+        skipped_size = 0
+        for url, work in plan.items():
+            cached = self.already_cached(url)
+            size = self.content_lengths.get(url) or 0
+
+            # Items, total bytes, bytes to download and bytes left out by
+            # the budget for each group
+            total = totals.setdefault(work.asset.group, [0, 0, 0, 0])
+            total[0] += 1
+            total[1] += size
+            if not cached:
+                total[2] += size
+                if skipped or (self.byte_budget and used + size > self.byte_budget):  # NOQA
+                    self.log.info('Byte budget used, skipping: %s' % url)
+                    skipped += 1
+                    skipped_size += size
+                    total[3] += size
+                    continue
+                used += size
+            budgeted[url] = work
+
+        where = ' [%s]' % urlparse(server).netloc if server and len(self.servers) > 1 else ''  # NOQA
+        for group, (items, size, uncached, over) in totals.items():
+            print 'Planned %s: %s items, %s (%s to download%s)%s' % (group, items, self.format_size(size), self.format_size(uncached), ', %s over the byte budget' % self.format_size(over) if over else '', where)  # NOQA
+            self.log.info('Planned %s: %s items, %s bytes (%s bytes to download, %s bytes over the byte budget)%s' % (group, items, size, uncached, over, where))  # NOQA
+        if skipped:
+            print 'Byte budget of %s used, skipping %s items, %s%s' % (self.format_size(self.byte_budget), skipped, self.format_size(skipped_size), where)  # NOQA
+        if self.dry_run:
+            print 'Estimated download: %s%s' % (self.describe_size(size=used), where)  # NOQA
+        return budgeted
+
     def cache_server(self):
-        '''Gets the Caching/Tetherator server address, by checking
+        '''Gets a list of Caching/Tetherator server addresses, by checking
         Caching/Tetherator configurations.'''
         # Two places a config file can exist depending on whether this is
         # Caching Server in Server.app or a tetherator machine.
@@ -215,15 +754,15 @@ class PreCache():
                     self.log.debug('No port for caching server found in %s' % plist)  # NOQA
                     raise Exception('No port found.')
             if port:
-                return 'http://localhost:%s' % port
+                return ['http://localhost:%s' % port]
             else:
                 return self.cache_locator()
         else:
             return self.cache_locator()
 
     def cache_locator(self):
-        '''Returns a formatted server address from the AssetCacheLocatorUtil
-        binary output'''
+        '''Returns a list of formatted server addresses from the
+        AssetCacheLocatorUtil binary output'''
         cmd = ['/usr/bin/AssetCacheLocatorUtil']
         try:
             result, error = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
@@ -235,8 +774,8 @@ class PreCache():
                         if item.replace(',', '') not in result:
                             result.append(item.replace(',', ''))
                 if len(result) > 0:
-                    self.log.debug('Success finding caching server: %s' % cmd)
-                    return 'http://%s' % result[0]
+                    self.log.debug('Success finding caching servers: %s' % cmd)  # NOQA
+                    return ['http://%s' % x for x in result]
                 else:
                     # If all else fails, raise an exception
                     self.log.debug('No caching server found.')
@@ -244,6 +783,109 @@ class PreCache():
         except:
             raise
 
+    def cache_plan(self, plan, server=None):
+        '''Caches the work items in a plan, returning a list of Transfers for
+        every item that was downloaded. If server is supplied the items are
+        cached on that server instead of the primary caching server, IPSW
+        files are only checked and saved for the primary server.'''
+        if not server:
+            server = self.server
+        primary = server == self.server
+        if not primary:
+            plan = collections.OrderedDict((self.server_url(url, server), work._replace(url=self.server_url(url, server))) for url, work in plan.items())  # NOQA
+
+        # URLs to download, and the text that describes each of them.
+        downloads = collections.OrderedDict()
+        sha_digests = {}
+
+        def queue_download(url, caching_text, sha_digest=None):
+            if url not in downloads:
+                downloads[url] = caching_text
+            if sha_digest:
+                sha_digests[url] = sha_digest
+
+        def cache(work):
+            item = work.asset
+            url = work.url
+            # Text that will be displayed in output
+            if any(group in item.group for group in ['app', 'installer']):  # NOQA
+                caching_text = '%s %s (%s)' % (item.product_title, item.version, item.group)  # NOQA
+            elif 'sucatalog' in item.group:
+                caching_text = '%s: %s - %s' % (item.product_id, item.product_title, self.correct_package_filename(os.path.basename(url)))  # NOQA
+            else:
+                if item.model_description:
+                    caching_text = '%s: %s - %s' % (item.model, item.model_description, item.product_title)  # NOQA
+                else:
+                    caching_text = '%s: %s' % (item.model, item.product_title)  # NOQA
+            if len(self.servers) > 1:
+                caching_text = '%s [%s]' % (caching_text, urlparse(server).netloc)  # NOQA
+
+            # Output filename for IPSW's
+            output_file = os.path.join(self.destination, self.correct_package_filename(os.path.basename(url)))  # NOQA
+
+            # Normal 'pkg' files get processed by this bracket
+            if not self.already_cached(url):  # NOQA
+                if self.dry_run:
+                    print 'Cache: %s (%s)' % (caching_text, self.describe_size(url))  # NOQA
+                else:
+                    print 'Caching: %s' % caching_text
+                    queue_download(url, caching_text, item.sha_digest)
+            else:
+                print 'Already cached: %s' % caching_text
+
+            # IPSW files are a little differnt. They may already be
+            # cached, but may still need to be re-downloaded.
+            if primary and output_file.endswith('.ipsw'):
+                if not self.already_cached(url):
+                    dry_download_text = 'Cache'
+                    download_text = 'Caching'
+                else:
+                    dry_download_text = 'Re-download'
+                    download_text = 'Re-downloading'
+
+                if os.path.exists(output_file) and item.sha_digest:
+                    print '  A file already exists, comparing digest for %s' % caching_text  # NOQA
+                    # SHA1 or MD5 digest for ipsw files
+                    if self.compare_digests(self.file_digest(output_file, digest_type='sha1'), item.sha_digest):  # NOQA
+                        if self.dry_run:
+                            print '  Skip: %s' % caching_text
+                        else:
+                            print '  Skipping: %s' % caching_text
+                    else:
+                        if self.dry_run:
+                            print '%s: %s (%s)' % (dry_download_text, caching_text, self.describe_size(url))  # NOQA
+                        else:
+                            print '%s: %s' % (download_text, caching_text)
+                            queue_download(url, caching_text, item.sha_digest)  # NOQA
+                elif not os.path.exists(output_file):
+                    if self.dry_run:
+                        print '%s: %s (%s)' % (dry_download_text, caching_text, self.describe_size(url))  # NOQA
+                    else:
+                        print '%s: %s' % (download_text, caching_text)
+                        queue_download(url, caching_text, item.sha_digest)  # NOQA
+
+        # Check the cache state and size of every planned URL up front,
+        # several at a time, then do the thing! This particular approach is
+        # used to avoid duplicating downloads where possible.
+        budgeted = self.budget_plan(plan, server)
+        for work in budgeted.values():
+            cache(work)
+
+        # Download everything queued above, several at a time.
+        transfers = self.download_all(downloads.keys(), sha_digests)
+        for transfer in transfers:
+            if transfer.error:
+                print 'Failed: %s (%s)' % (downloads[transfer.url], transfer.error)  # NOQA
+            elif not self.dry_run:
+                print 'Cached: %s' % downloads[transfer.url]
+
+        # Items left out by the byte budget are reported as failed, so they
+        # are tried again by the next run.
+        for url in plan:
+            if url not in budgeted:
+                transfers.append(self.Transfer(url=url, output_file=None, size=0, duration=0, digest=None, error=Exception('Byte budget used')))  # NOQA
+        return transfers
+
     # Compare two digests
     def compare_digests(self, digest_a, digest_b):
         if digest_a == digest_b:
@@ -257,37 +899,199 @@ class PreCache():
             if source in package_filename:
                 return package_filename.replace('?source=%s' % source, '')
 
-    def download(self, url):
-        '''Downloads the specified file using the curl binary.'''
-        # Change destination for package files to /tmp so we don't clutter
-        # ipsw destination
-        if '.pkg' in url:
-            self.destination = '/tmp'
-
-        # Basename the URL for curl file output
-        output_file = os.path.join(self.destination, self.correct_package_filename(os.path.basename(url)))  # NOQA
-
-        # curl called with minimal progress bar, and create directories if they
-        # don't exist, as well as provide a user agent string.
-        cmd = ['/usr/bin/curl', '--progress-bar', url, '-o', output_file, '--create-dirs', '--user-agent', self.user_agent]  # NOQA
+    def daemon(self, apps=None, groups=None, ipsw=None, mac_updates=None, models=None):  # NOQA
+        '''Runs until stopped, checking the feeds every poll_interval seconds
+        and only caching items that have appeared since the last check. Feeds
+        are revalidated with conditional requests, so a check where nothing
+        has changed costs a handful of small requests. Items that have been
+        processed are remembered in the state directory between restarts.'''
+        self.log.info('Daemon started, polling every %s seconds' % self.poll_interval)  # NOQA
+        while True:
+            start = time()
+            try:
+                # Assets and cache state are loaded fresh for each check.
+                self.sources.clear()
+                self.source_timings.clear()
+                with self.cache_state_lock:
+                    self.cache_state.clear()
+
+                with self.metrics.phase('plan'):
+                    plan = self.plan(apps=apps, groups=groups, ipsw=ipsw, mac_updates=mac_updates, models=models)  # NOQA
+                new_items = collections.OrderedDict((url, work) for url, work in plan.items() if self.seen_urls.get(url) is None)  # NOQA
+                self.log.info('Daemon check found %s new of %s items' % (len(new_items), len(plan)))  # NOQA
+
+                if new_items:
+                    # An item is only done once it is cached on every server
+                    failed = set(self.server_url(transfer.url, self.server) for transfer in self.warm(new_items) if transfer.error)  # NOQA
+                    if not self.dry_run:
+                        for url in new_items:
+                            if url not in failed:
+                                self.seen_urls.set(url, True)
+                        self.seen_urls.save()
+            except Exception as e:
+                self.log.info('Daemon check failed: %s' % e)
+
+            # Each check is a run as far as metrics are concerned.
+            self.write_metrics()
+            self.metrics.reset()
+
+            sleep(max(0, self.poll_interval - (time() - start)))
+
+    def describe_size(self, url=None, size=None):
+        '''Returns text with the size of a URL (from probing the caching
+        server) or the supplied number of bytes, and roughly how long it
+        will take to download at the link speed.'''
+        if url:
+            size = self.content_lengths.get(url)
+        if size is None:
+            return 'size unknown'
+        seconds = int(size * 8 / (self.link_speed * 1000000))
+        return '%s, about %s' % (self.format_size(size), timedelta(seconds=seconds))  # NOQA
+
+    def download(self, url, sha_digest=None):
+        '''Downloads the specified file, returning a Transfer with the
+        outcome of the download. Only IPSW files from the primary caching
+        server are written to disk, all other items are read in fixed size
+        chunks and discarded, which is enough for the caching server to store
+        them.
+        If sha_digest is supplied, the SHA1 digest of an IPSW file is
+        calculated as it downloads and must match before the file is moved
+        into place.'''
+        # Basename the URL for file output
+        filename = self.correct_package_filename(os.path.basename(url))
+        if filename and filename.endswith('.ipsw') and urlparse(url).netloc == urlparse(self.server).netloc:  # NOQA
+            output_file = os.path.join(self.destination, filename)
+        else:
+            output_file = None
 
         if self.dry_run:
-            print cmd
-        else:
-            subprocess.check_call(cmd)
+            print 'Download: %s' % url
+            return self.Transfer(url=url, output_file=output_file, size=0, duration=0, digest=None, error=None)  # NOQA
+
+        if self.deadline and time() > self.deadline:
+            self.log.info('Time budget used, skipping: %s' % url)
+            return self.Transfer(url=url, output_file=output_file, size=0, duration=0, digest=None, error=Exception('Time budget used'))  # NOQA
+
+        # IPSW files are downloaded to a partial file first. If a download is
+        # interrupted, the next attempt resumes from the end of the partial
+        # file with a Range request. The validators of the original response
+        # are kept alongside so a changed file is never appended to.
+        def download_file():
+            part_file = '%s.part' % output_file
+            progress_file = '%s.json' % part_file
+
+            # Create directories if they don't exist.
+            ensure_dir(os.path.dirname(output_file))
+
+            headers = {}
+            offset = 0
+            if os.path.exists(part_file):
+                offset = os.path.getsize(part_file)
+                try:
+                    with open(progress_file, 'r') as f:
+                        progress = json.load(f)
+                except:
+                    progress = {}
 
-        # Because curl doesn't like /dev/null as a file path, delete items
-        # downloaded if they're not IPSW files. Don't use shutil becase we only
-        # want to remove the file, not the complete path!
-        if not output_file.endswith('.ipsw'):  # NOQA
-            try:
-                os.remove(output_file)
-                self.log.debug('Deleted: %s' % output_file)
-            except Exception as e:
-                self.log.debug('Unable to delete %s: %s' % (output_file, e))
-                raise e
+                validator = progress.get('etag') or progress.get('last_modified')  # NOQA
+                if offset and validator:
+                    headers['Range'] = 'bytes=%s-' % offset
+                    headers['If-Range'] = validator
+                else:
+                    offset = 0
+
+            req = self.http_request('GET', url, headers=headers, stream=True)
+            if req.status_code == 416:
+                # The partial file can't be resumed, start again.
+                self.log.debug('Unable to resume %s, restarting' % url)
+                offset = 0
+                req = self.http_request('GET', url, stream=True)
+            req.raise_for_status()
+
+            h = hashlib.sha1()
+            if req.status_code == 206 and offset:
+                self.log.info('Resuming %s from %s bytes' % (url, offset))
+                mode = 'ab'
+                # The digest has to include the bytes already downloaded.
+                with open(part_file, 'rb') as f:
+                    for block in iter(lambda: f.read(self.chunk_size), b''):  # NOQA
+                        h.update(block)
+            else:
+                offset = 0
+                mode = 'wb'
+                with open(progress_file, 'w') as f:
+                    json.dump({'etag': req.headers.get('ETag'),
+                               'last_modified': req.headers.get('Last-Modified')}, f)  # NOQA
+
+            received = 0
+            with open(part_file, mode) as f:
+                for chunk in req.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    h.update(chunk)
+                    received += len(chunk)
+
+            # Only move the file into place once the download is complete.
+            expected = req.headers.get('Content-Length')
+            if expected and int(expected) != received:
+                raise Exception('Incomplete download, expected %s bytes, received %s' % (expected, received))  # NOQA
+
+            # A corrupt download is removed so the next attempt starts again.
+            digest = h.hexdigest()
+            if sha_digest and not self.compare_digests(digest, sha_digest):
+                os.remove(part_file)
+                os.remove(progress_file)
+                raise Exception('SHA1 digest mismatch, expected %s, received %s' % (sha_digest, digest))  # NOQA
+
+            os.rename(part_file, output_file)
+            os.remove(progress_file)
+            self.store_digest(output_file, 'sha1', digest)
+            return received, digest
+
+        start = time()
+        size = 0
+        digest = None
+        try:
+            # Limit the number of downloads from the same host.
+            with self.host_slot(url):
+                # The budget may have run out while waiting for the slot.
+                if self.deadline and time() > self.deadline:
+                    self.log.info('Time budget used, skipping: %s' % url)
+                    return self.Transfer(url=url, output_file=output_file, size=0, duration=0, digest=None, error=Exception('Time budget used'))  # NOQA
+                with self.metrics.phase('download'):
+                    if output_file:
+                        size, digest = download_file()
+                    else:
+                        req = self.http_request('GET', url, stream=True)
+                        req.raise_for_status()
+                        for chunk in req.iter_content(chunk_size=self.chunk_size):  # NOQA
+                            size += len(chunk)
+            self.log.debug('Downloaded %s bytes in %.1fs: %s' % (size, time() - start, url))  # NOQA
+            self.metrics.increment('http_bytes', size)
+            self.metrics.increment('downloads')
+        except Exception as e:
+            self.log.info('Download failed: %s: %s' % (url, e))
+            self.metrics.increment('http_bytes', size)
+            self.metrics.increment('download_failures')
+            return self.Transfer(url=url, output_file=output_file, size=size, duration=time() - start, digest=None, error=e)  # NOQA
+
+        return self.Transfer(url=url, output_file=output_file, size=size, duration=time() - start, digest=digest, error=None)  # NOQA
+
+    def download_all(self, urls, sha_digests=None):
+        '''Downloads all the supplied URLs concurrently, returning a list of
+        Transfers in the same order as the URLs. Downloads are started in the
+        order supplied, and none are started once the time budget is used.
+        sha_digests is an optional dictionary of URL to the expected SHA1
+        digest.'''
+        if not sha_digests:
+            sha_digests = {}
+
+        if self.time_budget:
+            self.deadline = time() + self.time_budget
+        else:
+            self.deadline = None
 
-        sleep(uniform(1, 2))
+        with self.metrics.phase('downloads'):
+            return self.map_concurrently(lambda url: self.download(url, sha_digest=sha_digests.get(url)), urls, self.download_workers)  # NOQA
 
     # Build digest for a specific file
     def file_digest(self, file_path, digest_type=None):
@@ -300,21 +1104,50 @@ class PreCache():
             digest_type = 'sha256'
 
         if digest_type in valid_digests:
+            # Only calculate the digest if the file has changed since the
+            # digest was stored, or verify is enabled.
+            cached = self.digest_cache.get('%s:%s' % (digest_type, os.path.abspath(file_path)))  # NOQA
+            if cached and not self.verify and cached['signature'] == self.file_signature(file_path):  # NOQA
+                self.log.debug('Using stored %s digest for %s' % (digest_type, file_path))  # NOQA
+                return cached['digest']
+
             h = hashlib.new(digest_type)
-            with open(file_path, 'rb') as f:
+            with self.metrics.phase('hashing'), open(file_path, 'rb') as f:
                 for block in iter(lambda: f.read(block_size), b''):
                     h.update(block)
-                return h.hexdigest()
+            self.store_digest(file_path, digest_type, h.hexdigest())
+            return h.hexdigest()
         else:
             raise Exception('%s not a valid digest - choose from %s' %
                             (digest_type, valid_digests))
 
+    def file_signature(self, file_path):
+        '''Returns the size, mtime and inode of a file, used to tell if a file
+        has changed since its digest was stored.'''
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime, stat.st_ino]
+
+    def format_size(self, size):
+        '''Returns a number of bytes as human readable text.'''
+        for unit in ['bytes', 'KB', 'MB', 'GB']:
+            if size < 1024:
+                break
+            size = size / 1024.0
+        else:
+            unit = 'TB'
+        if unit == 'bytes':
+            return '%s %s' % (int(size), unit)
+        return '%.1f %s' % (size, unit)
+
     def hardware_model(self):
         '''Returns the hardware model of the Mac being used. This is used for
         the namedtuple in software updates for macOS, mostly for pretty
         output.'''
         cmd = ['/usr/sbin/sysctl', 'hw.model']
-        result, error = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+        try:
+            result, error = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+        except OSError:
+            result = None
         if result:
             self.log.debug('Found Mac hardware model.')
             return result.strip('\n').split(' ')[1]
@@ -322,6 +1155,43 @@ class PreCache():
             self.log.debug('No Mac hardware model found.')
             return None
 
+    def host_slot(self, url):
+        '''Returns the semaphore limiting concurrent downloads from the host in
+        the supplied URL. Caching server URLs are limited by the upstream host
+        in their source parameter, so the caching server itself is only
+        limited by the number of download workers.'''
+        parsed = urlparse(url)
+        source = parse_qs(parsed.query).get('source')
+        host = (parsed.netloc, source[0]) if source else parsed.netloc
+        with self.host_slots_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.downloads_per_host)  # NOQA
+            return self.host_slots[host]
+
+    def http_request(self, method, url, **kwargs):
+        '''Makes a request using the shared HTTP session, applying the default
+        timeout if one isn't supplied. No more than max_connections requests
+        are made at the same time. The latency of each request is recorded
+        against the host.'''
+        kwargs.setdefault('timeout', self.timeout)
+        self.metrics.increment('http_requests')
+        with self.http_slots:
+            start = time()
+            try:
+                req = self.session.request(method, url, **kwargs)
+            except:
+                self.metrics.increment('http_errors')
+                raise
+            finally:
+                self.metrics.observe(urlparse(url).netloc, time() - start)
+
+        if req.status_code >= 400:
+            self.metrics.increment('http_errors')
+        # Streamed responses are counted by whatever reads them.
+        if not kwargs.get('stream'):
+            self.metrics.increment('http_bytes', len(req.content))
+        return req
+
     def ios_updates(self, iOS=False, watchOS=False, tvOS=False, models=None, groups=None):  # NOQA
         '''Returns a generator object with all the iOS/watchOS/tvOS updates.
         Any additional manipulation should be done by another
@@ -331,20 +1201,21 @@ class PreCache():
         # This list gets extended by the ios, watch, and tv feeds below.
         updates = []
 
+        feeds = []
         if iOS:
-            ios_feed = urljoin(self.configuration['iosBaseURL'], self.configuration['iosFeeds']['ios'])  # NOQA
-            updates.extend(self.read_feed(ios_feed)['Assets'])
-            self.log.debug('Extended udpates list with iOS feed')
+            feeds.append(('iOS', urljoin(self.configuration['iosBaseURL'], self.configuration['iosFeeds']['ios'])))  # NOQA
 
         if watchOS:
-            watch_feed = urljoin(self.configuration['iosBaseURL'], self.configuration['iosFeeds']['watch'])  # NOQA
-            updates.extend(self.read_feed(watch_feed)['Assets'])
-            self.log.debug('Extended udpates list with watchOS feed')
+            feeds.append(('watchOS', urljoin(self.configuration['iosBaseURL'], self.configuration['iosFeeds']['watch'])))  # NOQA
 
         if tvOS:
-            tv_feed = urljoin(self.configuration['iosBaseURL'], self.configuration['iosFeeds']['tv'])  # NOQA
-            updates.extend(self.read_feed(tv_feed)['Assets'])
-            self.log.debug('Extended udpates list with tvOS feed')
+            feeds.append(('tvOS', urljoin(self.configuration['iosBaseURL'], self.configuration['iosFeeds']['tv'])))  # NOQA
+
+        # The feeds are fetched at the same time.
+        results = self.run_concurrently([lambda url=url: self.read_feed(url)['Assets'] for name, url in feeds])  # NOQA
+        for (name, url), assets in zip(feeds, results):
+            updates.extend(assets)
+            self.log.debug('Extended udpates list with %s feed' % name)
 
         def cacheable(asset):
             try:
@@ -430,59 +1301,58 @@ class PreCache():
         # description of the device.
         print 'Building and processing this list output can take a few minutes. Please be patient.'  # NOQA
 
-        # Lists, lists everywhere.
-        ios_cacheable = []
-        mac_os_cacheable = []
-        apps_cacheable = []
-
-        def device_description(asset):
-            if 'Watch' not in asset:
-                url = 'https://api.ipsw.me/v2.1/%s/latest/name' % asset
-                self.log.debug('Getting device description: %s' % asset)
-                return requests.get(url, headers={'user-agent': self.user_agent}, timeout=10).text  # NOQA
-            else:
+        def device_description(model):
+            if 'Watch' in model:
                 return 'Apple Watch'
 
-        # Get iOS assets we can cache
-        ios_assets = self.ios_updates(iOS=True, watchOS=True, tvOS=True)
+            description = self.model_names.get(model)
+            if description:
+                return description
+
+            url = '%s/%s/latest/name' % (self.ipsw_base_url, model)
+            self.log.debug('Getting device description: %s' % model)
+            try:
+                req = self.http_request('GET', url)
+                req.raise_for_status()
+                description = req.text
+            except Exception as e:
+                self.log.debug('Unable to get device description for %s: %s' % (model, e))  # NOQA
+                return 'Unknown'
+
+            self.model_names.set(model, description)
+            return description
+
+        # All the feeds are fetched at the same time.
+        sources = ['ios', 'watch', 'tv', 'apps', 'sucatalog']
+        ios_assets, watch_assets, tv_assets, app_assets, mac_assets = self.run_concurrently([lambda name=name: self.load_source(name) for name in sources])  # NOQA
+        ios_assets = ios_assets + watch_assets + tv_assets
+
+        # Get iOS assets we can cache, sets are used so this stays quick no
+        # matter how many devices Apple adds.
+        ios_models = sorted(set('%s' % asset.model for asset in ios_assets))
 
         # It can take a while to get the human readable model description, so
         # only get this if verbose is supplied as an argument.
         # Otherwise, just output model numbers
         if verbose:
-            garbage_list = []
-            for asset in ios_assets:
-                asset_description = '%s' % asset.model
-                if asset_description not in garbage_list:
-                    garbage_list.append(asset_description)
-
-            # List comprehension over the garbage_list builds ios_cacheable
-            # list with the device model and human readable description.
-            ios_cacheable = ['%s: %s' % (x, device_description(x)) for x in garbage_list]  # NOQA
+            descriptions = self.map_concurrently(device_description, ios_models, self.metadata_workers)  # NOQA
+            self.model_names.save()
+            ios_cacheable = ['%s: %s' % (model, description) for model, description in zip(ios_models, descriptions)]  # NOQA
         else:
-            for asset in ios_assets:
-                asset_description = '%s' % asset.model
-                if asset_description not in ios_cacheable:
-                    ios_cacheable.append(asset_description)
-                    ios_cacheable.sort()
-
-        ios_cacheable.sort()
+            ios_cacheable = ios_models
 
         # Get macOS Apps we can cache
-        app_assets = self.app_updates()
+        apps_cacheable = collections.OrderedDict()
         for asset in app_assets:
-            asset_description = '%s: %s' % (asset.product_title, asset.version)  # NOQA
-            if asset_description not in apps_cacheable:
-                apps_cacheable.append(asset_description)
+            apps_cacheable['%s: %s' % (asset.product_title, asset.version)] = True  # NOQA
 
         # Get macOS Updates we can cache
-        mac_assets = self.software_updates()
+        mac_os_cacheable = collections.OrderedDict()
         for asset in mac_assets:
             asset_description = '%s: %s' % (asset.product_id, asset.product_title)  # NOQA
             if asset.version:
                 asset_description = '%s %s' % (asset_description, asset.version)  # NOQA
-            if asset_description not in mac_os_cacheable:
-                mac_os_cacheable.append(asset_description)
+            mac_os_cacheable[asset_description] = True
 
         if verbose:
             print '\niOS, watchOS, tvOS devices (model: description):'
@@ -504,198 +1374,62 @@ class PreCache():
         print 'Note for apps/macOS installers: Please use the app/installer name without the version when caching those items.'  # NOQA
         print 'Note for macOS Software updates: You can use the Product ID or part/all of the description to cache those items.'  # NOQA
 
+    def load_source(self, name):
+        '''Returns the assets from the named source, one of ios, watch, tv,
+        sucatalog or apps. Each source is only loaded the first time it is
+        needed, and the time taken is recorded in source_timings.'''
+        loaders = {
+            'ios': lambda: list(self.ios_updates(iOS=True)),
+            'watch': lambda: list(self.ios_updates(watchOS=True)),
+            'tv': lambda: list(self.ios_updates(tvOS=True)),
+            'sucatalog': lambda: list(self.software_updates()),
+            'apps': lambda: list(self.app_updates()),
+        }
+
+        if name not in self.sources:
+            with self.metrics.phase('source', name) as timer:
+                self.sources[name] = loaders[name]()
+            self.source_timings[name] = timer['seconds']
+            self.log.info('Loaded source %s: %s assets in %.2fs' % (name, len(self.sources[name]), self.source_timings[name]))  # NOQA
+        return self.sources[name]
+
     def main_processor(self, apps=None, groups=None, ipsw=None, mac_updates=None, models=None):  # NOQA
         '''Main processor that handles figuring out whether an item should be
         downloaded or not'''
         print 'Processing items to cache can take a few minutes. Please be patient.'  # NOQA
-        # Creating an empty list for updates to exist in for processing
-        updates = []
-
-        # Always need these in the updates list, and these are very lightweight
-        # to process compared to the sucatalog for macOS
-        updates.extend(self.ios_updates(iOS=True, watchOS=True, tvOS=True))
-        self.log.debug('updates list extended with all iOS update feeds.')
-
-        # Test if IPSW's have numbers
-        def has_digits(string):
-            return any(char.isdigit() for char in string)
-
-        # This is to handle instances where downloading a number of IPSW's
-        # for a specific set of models might be required.
-        ipsw_model_list = []
-        for item in updates:
-            if any(i in item.model for i in self.ipsw_capable) and item.model not in ipsw_model_list:  # NOQA
-                ipsw_model_list.append(item.model)
-                self.log.debug('Building IPSW model list %s' % item.model)
-        ipsw_model_list.sort()
-
-        # If no arguments are provided to main_processor() try and load from configuration  # NOQA
-        if self.use_config:
-            if not models:
-                try:
-                    if len(self.configuration['cacheModels']) >= 1:
-                        models = self.configuration['cacheModels']
-                        self.log.debug('No CLI arguments, loading models from configuration file.')  # NOQA
-                except:
-                    pass
-
-            if not ipsw:
-                try:
-                    if len(self.configuration['cacheIPSW']) >= 1:
-                        ipsw = self.configuration['cacheIPSW']
-                        self.log.debug('No CLI arguments, loading IPSW from configuration file.')  # NOQA
-                except:
-                    pass
-
-            if not groups:
-                try:
-                    if len(self.configuration['cacheGroups']) >= 1:
-                        groups = self.configuration['cacheGroups']
-                        self.log.debug('No CLI arguments, loading groups from configuration file.')  # NOQA
-                except:
-                    pass
-
-            if not apps:
-                try:
-                    if len(self.configuration['cacheApps']) >= 1:
-                        apps = self.configuration['cacheApps']
-                        self.log.debug('No CLI arguments, loading apps from configuration file.')  # NOQA
-                except:
-                    pass
-
-            if not mac_updates:
-                try:
-                    if len(self.configuration['cacheMacUpdates']) >= 1:
-                        apps = self.configuration['cacheMacUpdates']
-                        self.log.debug('No CLI arguments, loading Mac updates from configuration file.')  # NOQA
-                except:
-                    pass
-
-        # Because processing software updates can take a while, only do this if
-        # the sucatalog exists in groups or if software_updates exists
-        if (groups and 'sucatalog' in groups) or mac_updates:  # NOQA
-            updates.extend(self.software_updates())
-            self.log.debug('Loaded: sucatalog')
-
-        # Handle cacheable apps or macOS Installers
-        if (groups and any(group in groups for group in self.asset_groups)) or apps:  # NOQA
-            updates.extend(self.app_updates())
-            self.log.debug('Loaded: app updates')
-
-        # Sort by model
-        updates = sorted(updates, key=attrgetter('model'))
-        self.log.debug('Sorted updates list')
-
-        def load_all_ipsw_files():
-            self.log.debug('load_all_ipsw_files() called')
-            for model in ipsw_model_list:
-                if any(item in model for item in ipsw):
-                    _ipsw = self.request_ipsw(model)
-                    if _ipsw not in updates:
-                        updates.extend(_ipsw)
-
-        # Process IPSW's if requested
-        if ipsw:
-            if not any(has_digits(item) for item in ipsw):
-                load_all_ipsw_files()
-            else:
-                for item in ipsw:
-                    if item in ipsw_model_list:
-                        _ipsw = self.request_ipsw(item)
-                        if _ipsw not in updates:
-                            updates.extend(_ipsw)
-                    else:
-                        print '%s is not a valid model. Pick from %s' % (item, ipsw_model_list)  # NOQA
-
-        def cache(item):
-            for url in item.urls:
-                # Text that will be displayed in output
-                if any(group in item.group for group in ['app', 'installer']):  # NOQA
-                    caching_text = '%s %s (%s)' % (item.product_title, item.version, item.group)  # NOQA
-                elif 'sucatalog' in item.group:
-                    caching_text = '%s: %s - %s' % (item.product_id, item.product_title, self.correct_package_filename(os.path.basename(url)))  # NOQA
-                else:
-                    if item.model_description:
-                        caching_text = '%s: %s - %s' % (item.model, item.model_description, item.product_title)  # NOQA
-                    else:
-                        caching_text = '%s: %s' % (item.model, item.product_title)  # NOQA
-
-                # Output filename for IPSW's
-                output_file = os.path.join(self.destination, self.correct_package_filename(os.path.basename(url)))  # NOQA
-
-                # Normal 'pkg' files get processed by this bracket
-                if not self.already_cached(url):  # NOQA
-                    if self.dry_run:
-                        print 'Cache: %s' % caching_text
-                    else:
-                        print 'Caching: %s' % caching_text
-                        self.download(url)
-                else:
-                    print 'Already cached: %s' % caching_text
-
-                # IPSW files are a little differnt. They may already be
-                # cached, but may still need to be re-downloaded.
-                if output_file.endswith('.ipsw'):
-                    if not self.already_cached(url):
-                        dry_download_text = 'Cache'
-                        download_text = 'Caching'
-                    else:
-                        dry_download_text = 'Re-download'
-                        download_text = 'Re-downloading'
-
-                    if os.path.exists(output_file) and item.sha_digest:
-                        print '  A file already exists, comparing digest for %s' % caching_text  # NOQA
-                        # SHA1 or MD5 digest for ipsw files
-                        if self.compare_digests(self.file_digest(output_file, digest_type='sha1'), item.sha_digest):  # NOQA
-                            if self.dry_run:
-                                print '  Skip: %s' % caching_text
-                            else:
-                                print '  Skipping: %s' % caching_text
-                        else:
-                            if self.dry_run:
-                                print '%s: %s' % (dry_download_text, caching_text)  # NOQA
-                            else:
-                                print '%s: %s' % (download_text, caching_text)
-                                self.download(url)
-                    elif not os.path.exists(output_file):
-                        if self.dry_run:
-                            print '%s: %s' % (dry_download_text, caching_text)
-                        else:
-                            print '%s: %s' % (download_text, caching_text)
-                            self.download(url)
-
-        # Iterate the updates and do the thing!
-        # This particular approach is used to avoid duplicating downloads where
-        # possible.
-        for update in updates:
-            if models:
-                if (any(item in update.model for item in models)) and ('ipsw' not in update.group):  # NOQA
-                    self.log.debug('Model match, caching: %s' % update.model)
-                    cache(update)
-
-            if ipsw and update.group == 'ipsw':
-                if any(item in update.model for item in ipsw):
-                    self.log.debug('IPSW match, caching: %s' % update.model)
-                    cache(update)
-
-            if groups:
-                if (any(item in update.group for item in groups)):  # NOQA
-                    self.log.debug('Group match, caching: %s' % update.model)
-                    cache(update)
-
-            if mac_updates:  # or 'sucatalog' in update.group:
-                # Compare against produdct id and product title
-                if 'sucatalog' in update.group and ((any(item in update.product_id for item in mac_updates)) or any(item in update.product_title for item in mac_updates)):  # NOQA
-                    self.log.debug('Mac update match, caching: %s' % update.model)  # NOQA
-                    cache(update)
-
-            if apps:
-                if any(item in update.product_title for item in apps):
-                    self.log.debug('App/installer match, caching: %s' % update.model)  # NOQA
-                    cache(update)
+        with self.metrics.phase('plan'):
+            plan = self.plan(apps=apps, groups=groups, ipsw=ipsw, mac_updates=mac_updates, models=models)  # NOQA
+        return self.warm(plan)
+
+    def map_concurrently(self, function, items, workers):
+        '''Calls function with each of items, no more than workers at a time,
+        returning a list of the results in the same order as items. Items are
+        started in order. Any exception raised by a call is raised again once
+        all calls have finished.
+        Python 2 ignores Ctrl-C while waiting on a pool without a timeout, so
+        the results are waited for with one that is never reached. If the run
+        is interrupted, the pool is stopped and the script exits.'''
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map_async(function, items, chunksize=1).get(365 * 86400)  # NOQA
+        except KeyboardInterrupt:
+            # The workers are daemon threads, so transfers still running
+            # stop when the script exits.
+            pool.terminate()
+            self.log.info('Interrupted, stopping.')
+            print '\nInterrupted, stopping.'
+            sys.exit(1)
+        except:
+            pool.close()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+        return results
 
     def mdm_models(self, mdm=None, mdm_url=None, mdm_user=None, mdm_pass=None, mdm_token=None):  # NOQA
-        '''Returns a list of iOS devices from an MDM instance.'''
+        '''Returns a dictionary of iOS device models from an MDM instance, with
+        the number of devices for each model.'''
 
         # Default deaders for requests
         _headers = {
@@ -741,33 +1475,68 @@ class PreCache():
                     sys.exit(1)
 
             if mdm_url.startswith('https://'):
-                # Strips trailing slash and joins the JSSresources API path
-                mdm_url = '%s/JSSResource/mobiledevices' % mdm_url.rstrip('/')
+                # Strips trailing slash
+                mdm_url = mdm_url.rstrip('/')
                 try:
-                    # The requests module automatically base64 encodes the
-                    # supplied username & password)
-                    self.log.info('Requesting models from: %s' % mdm_url)
-                    req = requests.get(mdm_url, auth=HTTPBasicAuth(username, password), headers=_headers)  # NOQA
+                    # The Jamf Pro API returns the inventory in pages, which
+                    # needs a token. The requests module automatically base64
+                    # encodes the supplied username & password)
+                    req = self.http_request('POST', '%s/api/v1/auth/token' % mdm_url, auth=HTTPBasicAuth(username, password), headers=_headers)  # NOQA
                     if req.status_code == 401:
                         self.log.info('401 error: Unauthorized request. Invalid username or password.')  # NOQA
                         print '401 error: Unauthorized request. Invalid username or password.'  # NOQA
                         sys.exit(1)
                     elif req.status_code == 200:
+                        _headers['Authorization'] = 'Bearer %s' % req.json()['token']  # NOQA
+                        devices_url = '%s/api/v2/mobile-devices' % mdm_url
+                        self.log.info('Requesting models from: %s' % devices_url)  # NOQA
+
+                        def page(number):
+                            params = {'page': number, 'page-size': self.mdm_page_size}  # NOQA
+                            req = self.http_request('GET', devices_url, params=params, headers=_headers)  # NOQA
+                            req.raise_for_status()
+                            return req.json()
+
+                        # The first page gives the total number of devices,
+                        # the remaining pages are then requested together.
+                        first = page(0)
+                        pages = (first['totalCount'] + self.mdm_page_size - 1) // self.mdm_page_size  # NOQA
+                        jobs = [lambda number=number: page(number) for number in range(1, pages)]  # NOQA
+                        results = [first] + self.run_concurrently(jobs, workers=self.metadata_workers)  # NOQA
+
+                        # Count the devices for each model
+                        models = collections.Counter([x['modelIdentifier'] for result in results for x in result['results']])  # NOQA
+                    else:
+                        # Older Jamf servers only have the Classic API, which
+                        # returns every device in a single response.
+                        self.log.debug('Jamf Pro API unavailable (%s), using Classic API' % req.status_code)  # NOQA
+                        devices_url = '%s/JSSResource/mobiledevices' % mdm_url
+                        self.log.info('Requesting models from: %s' % devices_url)  # NOQA
+                        req = self.http_request('GET', devices_url, auth=HTTPBasicAuth(username, password), headers=_headers)  # NOQA
+                        if req.status_code == 401:
+                            self.log.info('401 error: Unauthorized request. Invalid username or password.')  # NOQA
+                            print '401 error: Unauthorized request. Invalid username or password.'  # NOQA
+                            sys.exit(1)
+                        req.raise_for_status()
                         req = req.json()['mobile_devices']
-                        # Make a unique list
-                        models = list(set([x['model_identifier'] for x in req]))  # NOQA
-                        if models:
-                            return models
-                        else:
-                            self.log.info('No models found in MDM.')
-                            return None
+                        # Count the devices for each model
+                        models = collections.Counter([x['model_identifier'] for x in req])  # NOQA
+
+                    if models:
+                        return models
+                    else:
+                        self.log.info('No models found in MDM.')
+                        return None
                 except Exception as e:
                     self.log.debug('Jamf Exception: %s' % e)
                     pass
 
         def simplemdm(auth_token=None):
             # No URL required as an argument as SimpleMDM is cloud only
-            mdm_url = 'https://a.simplemdm.com/api/v1/devices'
+            try:
+                mdm_url = self.configuration['simpleMDMURL']
+            except:
+                mdm_url = 'https://a.simplemdm.com/api/v1/devices'
 
             # Try and load from configuration file.
             if not auth_token:
@@ -779,25 +1548,48 @@ class PreCache():
                     sys.exit(1)
 
             try:
-                req = requests.get(mdm_url, auth=(auth_token, ""), headers=_headers).json()  # NOQA
-                if req['errors']:
-                    print req['errors'][0]['title']
-                    self.log.info(req['errors'][0]['title'])
-                    sys.exit(1)
+                self.log.info('Requesting models from: %s' % mdm_url)
+                models = collections.Counter()
+                # SimpleMDM pages with a cursor (the id of the last device
+                # returned), so each page has to wait for the one before it.
+                params = {'limit': self.mdm_page_size}
+                while True:
+                    req = self.http_request('GET', mdm_url, auth=(auth_token, ""), headers=_headers, params=params).json()  # NOQA
+                    if req.get('errors'):
+                        print req['errors'][0]['title']
+                        self.log.info(req['errors'][0]['title'])
+                        sys.exit(1)
+
+                    # Count the devices for each model
+                    models.update([x['attributes']['product_name'] for x in req['data']])  # NOQA
+                    if not req.get('has_more') or not req['data']:
+                        break
+                    params['starting_after'] = req['data'][-1]['id']
+
+                if models:
+                    return models
                 else:
-                    req = req['data']  # NOQA
-                    self.log.info('Requesting models from: %s' % mdm_url)
-                    # Make a unique list
-                    models = list(set([x['attributes']['product_name'] for x in req]))  # NOQA
-                    if models:
-                        return models
-                    else:
-                        self.log.info('No models found in MDM.')
-                        return None
+                    self.log.info('No models found in MDM.')
+                    return None
             except Exception as e:
                 self.log.debug('SimpleMDM Exception: %s' % e)
                 pass
 
+        def cached(key, fetch):
+            '''Returns the device counts stored under key if they haven't
+            expired, otherwise calls fetch and stores what it returns.'''
+            models = self.mdm_cache.get(key)
+            if models:
+                self.log.info('Using cached models from MDM.')
+                return collections.Counter(models)
+
+            with self.metrics.phase('mdm'):
+                models = fetch()
+            if models:
+                self.mdm_cache.set(key, dict(models))
+                self.mdm_cache.save()
+            return models
+
         if not mdm:
             try:
                 mdm = self.configuration['mdm']
@@ -810,7 +1602,9 @@ class PreCache():
             if 'simplemdm' in mdm:
                 if mdm_token:
                     try:
-                        return simplemdm(mdm_token)
+                        # The token is hashed so it isn't stored in the key
+                        key = 'simplemdm:%s' % hashlib.sha1(mdm_token).hexdigest()  # NOQA
+                        return cached(key, lambda: simplemdm(mdm_token))
                     except:
                         raise
                 else:
@@ -820,7 +1614,8 @@ class PreCache():
             elif 'jss' in mdm or 'jamf' in mdm:
                 if mdm_url and mdm_user and mdm_pass:  # NOQA
                     try:
-                        return jamf(mdm_url, mdm_user, mdm_pass)
+                        key = 'jamf:%s:%s' % (mdm_url.rstrip('/'), mdm_user)
+                        return cached(key, lambda: jamf(mdm_url, mdm_user, mdm_pass))  # NOQA
                     except:
                         raise
                 else:
@@ -832,25 +1627,302 @@ class PreCache():
                 self.log.info('Must specify MDM. Choose either \'simplemdm\' or \'jamf\'.')  # NOQA
                 sys.exit(1)
 
-    def read_feed(self, url):
+    def plan(self, apps=None, groups=None, ipsw=None, mac_updates=None, models=None):  # NOQA
+        '''Resolves the apps, groups, ipsw, mac_updates and models selectors
+        into a single set of work items keyed by URL. Each work item records
+        the asset the URL belongs to, and the reasons it was selected.'''
+        # If no arguments are provided to main_processor() try and load from configuration  # NOQA
+        if self.use_config:
+            if not models:
+                try:
+                    if len(self.configuration['cacheModels']) >= 1:
+                        models = self.configuration['cacheModels']
+                        self.log.debug('No CLI arguments, loading models from configuration file.')  # NOQA
+                except:
+                    pass
+
+            if not ipsw:
+                try:
+                    if len(self.configuration['cacheIPSW']) >= 1:
+                        ipsw = self.configuration['cacheIPSW']
+                        self.log.debug('No CLI arguments, loading IPSW from configuration file.')  # NOQA
+                except:
+                    pass
+
+            if not groups:
+                try:
+                    if len(self.configuration['cacheGroups']) >= 1:
+                        groups = self.configuration['cacheGroups']
+                        self.log.debug('No CLI arguments, loading groups from configuration file.')  # NOQA
+                except:
+                    pass
+
+            if not apps:
+                try:
+                    if len(self.configuration['cacheApps']) >= 1:
+                        apps = self.configuration['cacheApps']
+                        self.log.debug('No CLI arguments, loading apps from configuration file.')  # NOQA
+                except:
+                    pass
+
+            if not mac_updates:
+                try:
+                    if len(self.configuration['cacheMacUpdates']) >= 1:
+                        mac_updates = self.configuration['cacheMacUpdates']
+                        self.log.debug('No CLI arguments, loading Mac updates from configuration file.')  # NOQA
+                except:
+                    pass
+
+        # Work out which sources are needed by the selectors, so only the
+        # feeds that can match anything are loaded.
+        def mobile_sources(selector):
+            if selector.startswith('AppleTV'):
+                return ['tv']
+            elif selector.startswith('Watch'):
+                return ['watch']
+            elif any(selector.startswith(device) for device in self.ios_devices):  # NOQA
+                return ['ios']
+            else:
+                return ['ios', 'watch', 'tv']
+
+        sources = collections.OrderedDict()
+        for item in list(models or []) + list(ipsw or []):
+            sources.update((name, True) for name in mobile_sources(item))
+
+        for item in groups or []:
+            if item in ['app', 'installer']:
+                sources['apps'] = True
+            elif item == 'sucatalog':
+                sources['sucatalog'] = True
+            else:
+                sources.update((name, True) for name in mobile_sources(item))
+
+        if mac_updates:
+            sources['sucatalog'] = True
+
+        if apps:
+            sources['apps'] = True
+
+        # All the feeds needed are fetched and processed at the same time.
+        results = self.run_concurrently([lambda name=name: self.load_source(name) for name in sources])  # NOQA
+        results = dict(zip(sources, results))
+
+        # Creating an empty list for updates to exist in for processing
+        updates = []
+        for name in sources:
+            updates.extend(results[name])
+
+        # Test if IPSW's have numbers
+        def has_digits(string):
+            return any(char.isdigit() for char in string)
+
+        # This is to handle instances where downloading a number of IPSW's
+        # for a specific set of models might be required.
+        ipsw_model_list = set()
+        for item in [asset for name in ['ios', 'watch', 'tv'] for asset in results.get(name, [])]:  # NOQA
+            if any(i in item.model for i in self.ipsw_capable) and item.model not in ipsw_model_list:  # NOQA
+                ipsw_model_list.add(item.model)
+                self.log.debug('Building IPSW model list %s' % item.model)
+        ipsw_model_list = sorted(ipsw_model_list)
+
+        # Sort by model
+        updates = sorted(updates, key=attrgetter('model'))
+        self.log.debug('Sorted updates list')
+
+        # Process IPSW's if requested, the IPSW information for each model is
+        # requested at the same time.
+        ipsw_models = []
+        if ipsw:
+            if not any(has_digits(item) for item in ipsw):
+                self.log.debug('Loading all IPSW files')
+                ipsw_models = [model for model in ipsw_model_list if any(item in model for item in ipsw)]  # NOQA
+            else:
+                for item in ipsw:
+                    if item in ipsw_model_list:
+                        ipsw_models.append(item)
+                    else:
+                        print '%s is not a valid model. Pick from %s' % (item, ipsw_model_list)  # NOQA
+
+        if ipsw_models:
+            with self.metrics.phase('source', 'ipsw') as timer:
+                for result in self.run_concurrently([lambda model=model: list(self.request_ipsw(model)) for model in ipsw_models], workers=self.metadata_workers):  # NOQA
+                    updates.extend(result)
+            self.source_timings['ipsw'] = timer['seconds']
+            self.log.info('Loaded source ipsw: %s models in %.2fs' % (len(ipsw_models), self.source_timings['ipsw']))  # NOQA
+
+        self.log.info('Source timings: %s' % ', '.join('%s %.2fs' % (name, duration) for name, duration in self.source_timings.items()))  # NOQA
+
+        # Models from an MDM come with the number of devices for each model.
+        # Items are weighted by the number of devices they serve, so the most
+        # used models are cached first.
+        if isinstance(models, dict):
+            fleet = models
+        else:
+            fleet = {}
+
+        # Work items keyed by URL, so an asset matched by more than one
+        # selector is only processed once.
+        plan = collections.OrderedDict()
+
+        def select(update, reasons):
+            for url in update.urls:
+                if url not in plan:
+                    plan[url] = self.WorkItem(url=url, asset=update, reasons=[], weight=fleet.get(update.model, 0))  # NOQA
+                for reason in reasons:
+                    if reason not in plan[url].reasons:
+                        plan[url].reasons.append(reason)
+
+        # The selectors are compiled into lookup structures once, so each
+        # update can be matched without scanning every selector.
+        # Models match on any prefix of the model identifier, so 'iPad'
+        # matches every iPad and 'iPad6,8' only matches that model.
+        def prefix_matches(index, value):
+            if not value:
+                return []
+            return [value[:i] for i in range(1, len(value) + 1) if value[:i] in index]  # NOQA
+
+        # Titles match on any part of the title ('10.13' matches 'macOS
+        # 10.13.1 Update'). Selectors are kept in a set along with their
+        # lengths, so each position in a title is only looked up once for
+        # each length, however many selectors there are.
+        def substring_index(selectors):
+            index = set(item for item in selectors or [] if item.strip())
+            return index, sorted(set(len(item) for item in index))
+
+        def substring_matches(substrings, value):
+            index, lengths = substrings
+            if not value or not index:
+                return []
+            matches = []
+            for start in range(len(value)):
+                for length in lengths:
+                    if start + length > len(value):
+                        break
+                    item = value[start:start + length]
+                    if item in index and item not in matches:
+                        matches.append(item)
+            return matches
+
+        model_index = set(models or [])
+        ipsw_index = set(ipsw or [])
+        group_index = set(groups or [])
+        product_id_index = set(mac_updates or [])
+        title_index = substring_index(mac_updates)
+        app_index = substring_index(apps)
+
+        # Iterate the updates and find everything that matches.
+        for update in updates:
+            if model_index and 'ipsw' not in update.group:
+                matches = prefix_matches(model_index, update.model)
+                if matches:
+                    self.log.debug('Model match, caching: %s' % update.model)
+                    select(update, ['model:%s' % item for item in matches])
+
+            if ipsw_index and update.group == 'ipsw':
+                matches = prefix_matches(ipsw_index, update.model)
+                if matches:
+                    self.log.debug('IPSW match, caching: %s' % update.model)
+                    select(update, ['ipsw:%s' % item for item in matches])
+
+            if update.group in group_index:
+                self.log.debug('Group match, caching: %s' % update.model)
+                select(update, ['group:%s' % update.group])
+
+            if mac_updates and 'sucatalog' in update.group:
+                # Compare against product id and product title
+                matches = substring_matches(title_index, update.product_title)
+                if update.product_id in product_id_index:
+                    matches.insert(0, update.product_id)
+                if matches:
+                    self.log.debug('Mac update match, caching: %s' % update.model)  # NOQA
+                    select(update, ['mac_update:%s' % item for item in matches])  # NOQA
+
+            if apps:
+                matches = substring_matches(app_index, update.product_title)
+                if matches:
+                    self.log.debug('App/installer match, caching: %s' % update.model)  # NOQA
+                    select(update, ['app:%s' % item for item in matches])
+
+        if fleet:
+            plan = collections.OrderedDict(sorted(plan.items(), key=lambda item: item[1].weight, reverse=True))  # NOQA
+
+        self.log.debug('Planned %s URLs' % len(plan))
+        return plan
+
+    def probe(self, urls):
+        '''Checks the cache state of all the supplied URLs concurrently,
+        returning a dictionary of URL to True if the URL is already cached.'''
+        urls = list(collections.OrderedDict.fromkeys(urls))
+        with self.metrics.phase('probe'):
+            self.map_concurrently(self.already_cached, urls, self.probe_workers)  # NOQA
+        self.log.debug('Probed %s URLs' % len(urls))
+        return dict((url, self.cache_state[url]) for url in urls)
+
+    def read_feed(self, url, conditional=True):
         '''Reads any of the Apple XML/plist feeds required for software updates or
-        iOS updates'''
-        return readPlistFromString(requests.get(url, headers={'user-agent': self.user_agent}, timeout=10).text)  # NOQA
+        iOS updates. Feeds are revalidated using the ETag/Last-Modified headers
+        from the previous run, and the stored copy is used if the feed has not
+        changed. Set conditional to False for documents that should not be
+        stored.'''
+        if not conditional:
+            with self.metrics.phase('metadata_fetch'):
+                body = self.http_request('GET', url).content
+            with self.metrics.phase('metadata_parse'):
+                return readPlistFromString(body)
+
+        headers = {}
+
+        feed_file = os.path.join(self.state_dir, 'feeds', hashlib.sha1(url).hexdigest())  # NOQA
+        validators = self.feed_cache.get(url)
+        if validators and os.path.exists(feed_file):
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        else:
+            validators = None
+
+        with self.metrics.phase('feed_fetch', url):
+            req = self.http_request('GET', url, headers=headers)
+        if req.status_code == 304 and validators:
+            self.log.debug('Feed not modified: %s' % url)
+            self.metrics.increment('feeds_not_modified')
+            if url in self.parsed_feeds:
+                return self.parsed_feeds[url]
+            with open(feed_file, 'rb') as f:
+                body = f.read()
+        else:
+            body = req.content
+            etag = req.headers.get('ETag')
+            last_modified = req.headers.get('Last-Modified')
+            if req.status_code == 200 and (etag or last_modified):
+                try:
+                    ensure_dir(os.path.dirname(feed_file))
+                    with open(feed_file, 'wb') as f:
+                        f.write(body)
+                    self.feed_cache.set(url, {'etag': etag, 'last_modified': last_modified})  # NOQA
+                    self.feed_cache.save()
+                    self.log.debug('Stored feed: %s' % url)
+                except Exception as e:
+                    self.log.debug('Unable to store feed %s: %s' % (url, e))  # NOQA
+
+        with self.metrics.phase('feed_parse', url):
+            self.parsed_feeds[url] = readPlistFromString(body)
+        return self.parsed_feeds[url]
 
     def reformat_url(self, url):
         '''Formats the URL into the format required by the caching service:
            http://cacheserver:1234?source=source.apple.com'''
-        cache_server = 'http://thor:49672'
         url = urlparse(url)
-        return '%s%s?source=%s' % (cache_server, url.path, url.netloc)  # NOQA
+        return '%s%s?source=%s' % (self.server, url.path, url.netloc)  # NOQA
 
     def request_ipsw(self, device_model):
         '''Returns the URL for the IPSW of the specified model, as well as the
         version of the IPSW.'''
         if 'Watch' not in device_model:
-            url = 'https://api.ipsw.me/v2.1/%s/latest/info.json' % device_model
+            url = '%s/%s/latest/info.json' % (self.ipsw_base_url, device_model)  # NOQA
             try:
-                ipsw_json = requests.get(url, headers={'user-agent': self.user_agent}, timeout=10).json()[0]  # NOQA
+                ipsw_json = self.http_request('GET', url).json()[0]
 
                 try:
                     rel_date = ipsw_json['releasedate']
@@ -880,6 +1952,22 @@ class PreCache():
             except:
                 pass
 
+    def run_concurrently(self, jobs, workers=None):
+        '''Calls each function in jobs at the same time, returning a list of
+        the results in the same order as jobs. Any exception raised by a job
+        is raised again once all jobs have finished.'''
+        if not jobs:
+            return []
+
+        return self.map_concurrently(lambda job: job(), jobs, workers or len(jobs))  # NOQA
+
+    def server_url(self, url, server):
+        '''Returns a caching server URL with the server replaced by the
+        supplied server.'''
+        url = urlparse(url)
+        server = urlparse(server)
+        return url._replace(scheme=server.scheme, netloc=server.netloc).geturl()  # NOQA
+
     def software_updates(self):
         '''Returns a generator object with all the software updates
         (filtered). Any additional manipulation should be done by another
@@ -894,7 +1982,11 @@ class PreCache():
 
         # Get all the metadata for a product
         def metadata(product_id):
-            return self.read_feed(metadata_url(product_id))  # NOQA
+            try:
+                return self.read_feed(metadata_url(product_id), conditional=False)  # NOQA
+            except Exception as e:
+                self.log.debug('Unable to load metadata for %s: %s' % (product_id, e))  # NOQA
+                return None
 
         # Get the product title from the software update
         def su_title(product_metadata):
@@ -937,34 +2029,108 @@ class PreCache():
                     chars[chars.index(char)] = ' ' + char
             return ''.join(chars)
 
-        # Work through product updates and generate the namedtuple
-        for product_id in products:
-            try:
-                _metadata = metadata(product_id)
-            except:
-                pass
-            # List comprehension for all urls ending with '.pkg' as many updats
-            # have more than one package file.
-            urls = [self.reformat_url(pkg['URL']) for pkg in products[product_id]['Packages'] if pkg['URL'].endswith('.pkg')]  # NOQA
-            try:
-                title = su_title(_metadata)
-            except:
-                title = None
+        # Cheap filters that only need the catalog entry for a product. These
+        # are applied before any metadata is fetched, as the bulk of the
+        # sucatalog is old cruft that would be excluded anyway.
+        try:
+            include_products = self.configuration['sucatalogIncludeProducts']
+        except:
+            include_products = []
+
+        try:
+            exclude_products = self.configuration['sucatalogExcludeProducts']
+        except:
+            exclude_products = []
+
+        try:
+            exclude_urls = self.configuration['sucatalogExcludeURLs']
+        except:
+            exclude_urls = []
+
+        # List comprehension for all urls ending with '.pkg' as many updates
+        # have more than one package file.
+        def package_urls(product_id):
+            return [pkg['URL'] for pkg in products[product_id].get('Packages', []) if pkg['URL'].endswith('.pkg') and not any(item in pkg['URL'] for item in exclude_urls)]  # NOQA
+
+        def catalog_filter(product_id):
+            # Don't care for updates before the El Capitan release date.
             try:
-                _version = product_version(_metadata)
+                if products[product_id]['PostDate'] < min_date:
+                    return False
             except:
-                _version = None
-
-            # There are _so many updates_, so this is a filter to exclude.
-            # Most of this is old cruft, some of it is stuff that really can be
-            # managed by clients just requesting it as they update. We really
-            # only care about the "big" stuff.
-            # You can edit this if you want, but it reverts when you update via
-            # `git pull`
-            # If any products are missed as a result of the filter, it's not
-            # _that_ big an issue as the product _should_ get cached on first
-            # request anyway.
-            exclude = self.configuration['sucatalogExcludes']
+                return False
+
+            if include_products and product_id not in include_products:
+                return False
+
+            if product_id in exclude_products:
+                return False
+
+            if not package_urls(product_id):
+                return False
+
+            return True
+
+        product_ids = [x for x in products if catalog_filter(x)]
+        self.log.debug('%s of %s products remain after catalog filters' % (len(product_ids), len(products)))  # NOQA
+
+        # Get the title and version for a product, fetching the metadata
+        # for it if this product id has not been seen before.
+        def product_info(product_id):
+            with self.metrics.phase('product_info'):
+                _metadata = metadata(product_id)
+                try:
+                    title = su_title(_metadata)
+                except:
+                    title = None
+                try:
+                    _version = product_version(_metadata)
+                except:
+                    _version = None
+
+                info = {'title': title, 'version': _version}
+                if title:
+                    self.metadata_cache.set(product_id, info)
+                return info
+
+        all_info = {}
+        for product_id in product_ids:
+            info = self.metadata_cache.get(product_id)
+            if info:
+                all_info[product_id] = info
+        missing = [x for x in product_ids if x not in all_info]
+        self.log.debug('Metadata cache hits: %s, misses: %s' % (len(all_info), len(missing)))  # NOQA
+
+        # Fetch the metadata for the remaining products concurrently, this is
+        # by far the slowest part of processing the sucatalog. The pool
+        # returns results in the same order as the product ids supplied.
+        if missing:
+            all_info.update(zip(missing, self.map_concurrently(product_info, missing, self.metadata_workers)))  # NOQA
+            self.log.debug('Fetched metadata for %s products' % len(missing))  # NOQA
+            self.metadata_cache.save()
+
+        # There are _so many updates_, so this is a filter to exclude.
+        # Most of this is old cruft, some of it is stuff that really can be
+        # managed by clients just requesting it as they update. We really
+        # only care about the "big" stuff.
+        # You can edit this if you want, but it reverts when you update via
+        # `git pull`
+        # If any products are missed as a result of the filter, it's not
+        # _that_ big an issue as the product _should_ get cached on first
+        # request anyway.
+        exclude = self.configuration['sucatalogExcludes']
+
+        # Work through product updates and generate the namedtuple
+        for product_id in product_ids:
+            urls = [self.reformat_url(url) for url in package_urls(product_id)]  # NOQA
+            title = all_info[product_id]['title']
+            _version = all_info[product_id]['version']
+
+            # Without metadata there is no title to filter or match on.
+            if not title:
+                self.log.debug('No title found for %s, skipping' % product_id)  # NOQA
+                continue
+
             if not any(item in title for item in exclude):
                 # Clarify what release the Safari packge is for, pass if this
                 # isn't possible.
@@ -977,31 +2143,105 @@ class PreCache():
                         except:
                             pass
 
-                # Don't care for updates before the El Capitan release date.
-                if products[product_id]['PostDate'] >= min_date:
-                    asset = self.asset(
-                        model=self.mac_model,
-                        version=_version,
-                        urls=urls,
-                        group='sucatalog',
-                        product_id=product_id,
-                        product_title=title,
-                        release_date=products[product_id]['PostDate']
-                    )
-                    if asset not in software_updates:
-                        software_updates.append(asset)
+                asset = self.asset(
+                    model=self.mac_model,
+                    version=_version,
+                    urls=urls,
+                    group='sucatalog',
+                    product_id=product_id,
+                    product_title=title,
+                    release_date=products[product_id]['PostDate']
+                )
+                if asset not in software_updates:
+                    software_updates.append(asset)
 
         # Sorting through the assets, newest first.
         software_updates = sorted(software_updates, key=attrgetter('release_date'), reverse=True)  # NOQA
         for update in software_updates:
             yield update
 
+    def store_digest(self, file_path, digest_type, digest):
+        '''Stores the digest of a file so it doesn't need to be calculated
+        again unless the file changes.'''
+        self.digest_cache.set('%s:%s' % (digest_type, os.path.abspath(file_path)), {  # NOQA
+            'signature': self.file_signature(file_path),
+            'digest': digest,
+        })
+        self.digest_cache.save()
+
+    def warm(self, plan):
+        '''Caches the work items in a plan on every caching server at the
+        same time, returning a list of Transfers for all the servers. The plan
+        is only built once, each server then fetches the items from Apple.
+        A summary is printed for each server.'''
+        if len(self.servers) == 1:
+            return self.cache_plan(plan)
+
+        def warm_server(server):
+            try:
+                return self.cache_plan(plan, server=server)
+            except Exception as e:
+                self.log.info('Caching on %s failed: %s' % (server, e))
+                return [self.Transfer(url=self.server_url(url, server), output_file=None, size=0, duration=0, digest=None, error=e) for url in plan]  # NOQA
+
+        results = self.run_concurrently([lambda server=server: warm_server(server) for server in self.servers])  # NOQA
+        transfers = []
+        for server, server_transfers in zip(self.servers, results):
+            failed = len([x for x in server_transfers if x.error])
+            print 'Server %s: %s transferred, %s failed' % (server, len(server_transfers) - failed, failed)  # NOQA
+            self.log.info('Server %s: %s transferred, %s failed' % (server, len(server_transfers) - failed, failed))  # NOQA
+            transfers.extend(server_transfers)
+        return transfers
+
+    def write_metrics(self):
+        '''Logs how long each phase of the run took, and writes the metrics
+        for the run to metrics.json and precache.prom (for the Prometheus
+        node_exporter textfile collector) in metrics_dir. When profiling, the
+        stats for each phase are written to profile_dir and the top
+        functions for each are logged.'''
+        metrics = self.metrics.as_dict()
+        self.log.info('Phase timings: %s' % ', '.join('%s%s %.2fs' % (phase['phase'], ' %s' % phase['item'] if phase['item'] else '', phase['seconds']) for phase in metrics['phases']))  # NOQA
+        self.log.info('Counters: %s' % ', '.join('%s %s' % (name, value) for name, value in sorted(metrics['counters'].items())))  # NOQA
+        try:
+            self.metrics.write(os.path.join(self.metrics_dir, 'metrics.json'), os.path.join(self.metrics_dir, 'precache.prom'))  # NOQA
+        except Exception as e:
+            self.log.info('Unable to write metrics: %s' % e)
+
+        if self.metrics.profile:
+            try:
+                for path, summary in self.metrics.write_profiles(self.profile_dir, top=self.profile_top).items():  # NOQA
+                    self.log.info('Profile written to %s\n%s' % (path, summary))  # NOQA
+            except Exception as e:
+                self.log.info('Unable to write profiles: %s' % e)
+
+    def write_plan(self, plan):
+        '''Prints the work items in a plan as JSON, along with the size and
+        cache state of each item from the caching server.'''
+        items = []
+        cached = self.probe(plan.keys())
+        for work in plan.values():
+            items.append({
+                'url': work.url,
+                'model': work.asset.model,
+                'group': work.asset.group,
+                'product_id': work.asset.product_id,
+                'product_title': work.asset.product_title,
+                'version': work.asset.version,
+                'release_date': str(work.asset.release_date) if work.asset.release_date else None,  # NOQA
+                'reasons': work.reasons,
+                'weight': work.weight,
+                'size': self.content_lengths.get(work.url),
+                'cached': cached[work.url],
+            })
+        print json.dumps(items, indent=2, sort_keys=True)
+
     def write_out(self, message):
-        '''Dynamic output on screen that overwrites itself.'''
-        sys.stdout.write("\r ")
-        sys.stdout.flush()
-        sys.stdout.write("\r%s\t" % message)
-        sys.stdout.flush()
+        '''Dynamic output on screen that overwrites itself. It's written to
+        stderr, so output such as --plan can be redirected on its own.'''
+        sys.stderr.write("\r ")
+        sys.stderr.flush()
+        sys.stderr.write("\r%s\t" % message)
+        sys.stderr.flush()
 
     # This isn't used yet, but may in the future
     def tetherator_status(self, plist):
@@ -1082,6 +2322,14 @@ def main():
                         help='Cache specific apps',
                         required=False)
 
+    parser.add_argument('--byte-budget',
+                        type=int,
+                        nargs=1,
+                        dest='byte_budget',
+                        metavar='bytes',
+                        help='Stop caching new items once this many bytes are planned.',  # NOQA
+                        required=False)
+
     parser.add_argument('--cache-group',
                         type=str,
                         nargs='+',
@@ -1093,10 +2341,16 @@ def main():
 
     parser.add_argument('-cs', '--cache-server',
                         type=str,
-                        nargs=1,
+                        nargs='+',
                         dest='cache_server',
                         metavar='http://cacheserver:port',
-                        help='Specify the cache server to use.',
+                        help='Specify the cache servers to use. Items are cached on every server.',  # NOQA
+                        required=False)
+
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        dest='daemon',
+                        help='Keep running, checking for and caching new items every pollInterval seconds.',  # NOQA
                         required=False)
 
     parser.add_argument('-d', '--destination',
@@ -1170,6 +2424,26 @@ def main():
                         help='Provide model(s). For example: iPad6,8',
                         required=False)
 
+    parser.add_argument('--plan',
+                        action='store_true',
+                        dest='plan',
+                        help='Print the items that would be cached as JSON, without caching them.',  # NOQA
+                        required=False)
+
+    parser.add_argument('--profile',
+                        action='store_true',
+                        dest='profile',
+                        help='Profile each phase of the run, writing a stats file for each.',  # NOQA
+                        required=False)
+
+    parser.add_argument('--time-budget',
+                        type=int,
+                        nargs=1,
+                        dest='time_budget',
+                        metavar='seconds',
+                        help='Stop starting new downloads after this many seconds.',  # NOQA
+                        required=False)
+
     parser.add_argument('-u', '--updates',
                         type=str,
                         nargs='+',
@@ -1184,6 +2458,12 @@ def main():
                         help='Shows what would be cached.',
                         required=False)
 
+    parser.add_argument('--verify',
+                        action='store_true',
+                        dest='verify',
+                        help='Re-calculate digests of existing IPSW files instead of using stored digests.',  # NOQA
+                        required=False)
+
     parser.add_argument('--version',
                         action='store_true',
                         dest='ver',
@@ -1197,6 +2477,7 @@ def main():
     if len(sys.argv) == 1:
         p = PreCache(use_config=True)
         p.main_processor()
+        p.write_metrics()
     # If arguments are supplied, process them.
     elif len(sys.argv) > 1:
         if args.ver:
@@ -1209,7 +2490,7 @@ def main():
             _destination = None
 
         if args.cache_server:
-            _cache_server = args.cache_server[0]
+            _cache_server = args.cache_server
         else:
             _cache_server = None
 
@@ -1219,8 +2500,9 @@ def main():
             sys.exit(1)
         else:
             if args.list:
-                p = PreCache(server=_cache_server, destination=_destination, dry_run=True)  # NOQA
+                p = PreCache(server=_cache_server, destination=_destination, dry_run=True, profile=args.profile)  # NOQA
                 p.list_assets(verbose=True)
+                p.write_metrics()
             else:
                 if args.apps:
                     _apps = args.apps
@@ -1247,8 +2529,20 @@ def main():
                 else:
                     _mac_updates = None
 
+                if args.time_budget:
+                    _time_budget = args.time_budget[0]
+                else:
+                    _time_budget = None
+
+                if args.byte_budget:
+                    _byte_budget = args.byte_budget[0]
+                else:
+                    _byte_budget = None
+
                 # Init class here so we can use p.mdm_models later.
-                p = PreCache(server=_cache_server, destination=_destination, dry_run=_dry_run)  # NOQA
+                # Daemon mode falls back to the configuration file for
+                # anything not provided as an argument.
+                p = PreCache(server=_cache_server, destination=_destination, dry_run=_dry_run, use_config=args.daemon, verify=args.verify, time_budget=_time_budget, byte_budget=_byte_budget, profile=args.profile)  # NOQA
 
                 # Continue processing args.
                 if args.models:
@@ -1309,11 +2603,18 @@ def main():
 
                     # Avengers assemble! Well, just models anyways.
                     _models = p.mdm_models(mdm=_mdm, mdm_url=_mdm_server, mdm_user=_mdm_user, mdm_pass=_mdm_pass, mdm_token=_mdm_token)  # NOQA
-                else:
-                    _models = None
 
-                # Call the main processor method to actually do the caching
-                p.main_processor(apps=_apps, groups=_groups, ipsw=_ipsw_models, mac_updates=_mac_updates, models=_models)  # NOQA
+                # Print the plan, or call the main processor method to
+                # actually do the caching
+                if args.plan:
+                    with p.metrics.phase('plan'):
+                        _plan = p.plan(apps=_apps, groups=_groups, ipsw=_ipsw_models, mac_updates=_mac_updates, models=_models)  # NOQA
+                    p.write_plan(_plan)
+                elif args.daemon:
+                    p.daemon(apps=_apps, groups=_groups, ipsw=_ipsw_models, mac_updates=_mac_updates, models=_models)  # NOQA
+                else:
+                    p.main_processor(apps=_apps, groups=_groups, ipsw=_ipsw_models, mac_updates=_mac_updates, models=_models)  # NOQA
+                p.write_metrics()
 
 
 # Run main()